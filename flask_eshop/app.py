@@ -1,69 +1,647 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, send_from_directory
+from flask import Flask, render_template, make_response, stream_template, Response, request, redirect, url_for, session, flash, g, jsonify, send_from_directory, send_file, abort, has_request_context
+from flask.logging import default_handler
 import sqlite3
 import bcrypt
 import os
 import urllib.request
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlencode
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from contextlib import contextmanager
 import uuid
 import re
 from functools import wraps
 import time
+import threading
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import atexit
+import cProfile
+import pstats
+import tracemalloc
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+import zlib
+import gzip
+import shutil
+import mimetypes
+import click
+import bisect
+import copy
+import random
+from array import array
+
+# Brotli is optional; without it responses are only gzip-compressed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# fcntl is Unix-only; without it the backup lock only covers the current process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
 # Database configuration
-DATABASE = 'eshop.db'
+DATABASE = os.environ.get('DATABASE', 'eshop.db')
 
 # Image upload configuration
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
 
+# Orphaned upload garbage collection
+UPLOAD_GC_GRACE_PERIOD = 24 * 3600  # never delete files younger than this
+UPLOAD_GC_BATCH_SIZE = 50
+UPLOAD_GC_PAUSE = 0.5  # seconds between batches so the disk isn't stalled
+
+# In-memory catalog read model for home(); falls back to SQL when disabled
+CATALOG_ENGINE_ENABLED = os.environ.get('CATALOG_ENGINE', '0') == '1'
+app.config['CATALOG_ENGINE'] = CATALOG_ENGINE_ENABLED
+
+# Catalog sort orders; product_id breaks ties so pages never overlap
+CATALOG_SORTS = {
+    'newest': ('created_at', True),
+    'oldest': ('created_at', False),
+    'price_low': ('price', False),
+    'price_high': ('price', True),
+    'name_az': ('name', False),
+    'name_za': ('name', True),
+    'popular': ('popularity', True),
+}
+# Best sellers: every unit sold adds popularity_weight() to products.popularity. Weights grow
+# by 2x per half-life (forward decay), so ordering by the stored sum equals ordering by a
+# decayed count without ever rewriting old rows.
+POPULARITY_HALF_LIFE_DAYS = 30
+POPULARITY_EPOCH = 1704067200  # 2024-01-01 UTC
+CATALOG_PER_PAGE = 12
+
+# SQLite's LIKE only folds ASCII case, so the in-memory search does the same
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+# Search terms are matched literally: LIKE wildcards in the term are escaped with a backslash
+LIKE_ESCAPES = str.maketrans({'\\': '\\\\', '%': '\\%', '_': '\\_'})
+
+# Search suggestions
+SUGGEST_LIMIT = 8
+SUGGEST_SCAN_LIMIT = 500  # above this many matching terms, search walks entries by popularity
+
+# Most changes accepted by one /api/cart request
+CART_BATCH_MAX_CHANGES = 50
+CART_MAX_QUANTITY = 10000  # largest quantity change accepted for one product
+
+# "Customers also bought" recommendations
+RECOMMENDATIONS_PER_PRODUCT = 4
+RECOMMENDATIONS_CHUNK_ORDERS = 5000  # orders folded into the co-purchase table per transaction
+RECOMMENDATIONS_RANK_BATCH = 500  # products whose top-N list is recomputed per transaction
+RECOMMENDATIONS_PAUSE = 0.05  # seconds between transactions so writers aren't starved
+
+# Uploaded images get unique names and are never modified, so they can be cached forever
+UPLOAD_MAX_AGE = 365 * 24 * 3600  # 1 year
+FAVICON_MAX_AGE = 7 * 24 * 3600  # 1 week
+# Hand uploads off to the front-end server instead of streaming them from Python:
+# USE_X_SENDFILE=1 for Apache/lighttpd, UPLOAD_ACCEL_REDIRECT=/internal-uploads/ for nginx
+UPLOAD_ACCEL_REDIRECT = os.environ.get('UPLOAD_ACCEL_REDIRECT', '')
+
+# Old orders in a terminal status are moved to an attached archive database
+ARCHIVE_DATABASE = os.environ.get('ARCHIVE_DATABASE', 'eshop_archive.db')
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_CHUNK_SIZE = 500
+ARCHIVE_PAUSE = 0.2  # seconds between chunks so writers aren't starved
+ARCHIVE_STATUSES = ('shipped', 'cancelled')
+
+# Online backups
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_KEEP = 7
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.05  # seconds between steps so live writers can take the lock
+
+app.config['DATABASE'] = DATABASE
+app.config['ARCHIVE_DATABASE'] = ARCHIVE_DATABASE
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
 # Rate limiting storage
 login_attempts = {}
 
+# Metrics configuration
+# Server-Timing is opt-in so the DB breakdown is only exposed when the frontend team asks for it
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING', '0') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Each worker process writes its counters here as <pid>.json, and /metrics and the slow
+# query page add up every file, so any worker can answer a scrape for the whole server.
+# Other workers' numbers are at most METRICS_FLUSH_INTERVAL seconds old.
+METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+METRICS_FLUSH_INTERVAL = 5  # seconds
+
+app.config['SERVER_TIMING'] = SERVER_TIMING_ENABLED
+
+# Admission control: each route class gets its own in-flight slots and a bounded queue.
+# Browse and search are shed with a fast 503 when full so they can never starve cart and
+# checkout. Limits are per worker process and sized against gunicorn's THREADS below.
+ADMISSION_CONTROL_ENABLED = os.environ.get('ADMISSION_CONTROL', '1') == '1'
+ADMISSION_RETRY_AFTER = 2  # seconds
+ADMISSION_CLASSES = {
+    # class: (max in flight, max queued, queue timeout in seconds)
+    'browse': (4, 4, 0.25),
+    'search': (2, 2, 0.25),
+    'cart': (4, 16, 5.0),
+    'checkout': (4, 16, 10.0),
+    'admin': (2, 8, 10.0),
+    'auth': (2, 8, 5.0),
+}
+# Queued requests hold a worker thread too, so the classes above could tie up every thread.
+# The in-flight slots of the reserved classes get threads of their own; everything else
+# (the other classes, and reserved requests that have to queue) shares the rest, so browse
+# and search can never take the threads cart and checkout run on. THREADS must match gunicorn's.
+ADMISSION_THREADS = int(os.environ.get('THREADS', 16))
+ADMISSION_RESERVED_CLASSES = ('cart', 'checkout')
+ADMISSION_SHARED_THREADS = max(1, ADMISSION_THREADS - sum(
+    ADMISSION_CLASSES[name][0] for name in ADMISSION_RESERVED_CLASSES))
+ADMISSION_ROUTES = {
+    'home': 'browse',
+    'product_detail': 'browse',
+    'user_orders': 'browse',
+    'search': 'search',
+    'suggest': 'search',
+    'view_cart': 'cart',
+    'add_to_cart': 'cart',
+    'update_cart': 'cart',
+    'remove_from_cart': 'cart',
+    'batch_update_cart': 'cart',
+    'checkout': 'checkout',
+    'register': 'auth',
+    'login': 'auth',
+    'logout': 'auth',
+}
+
+app.config['ADMISSION_CONTROL'] = ADMISSION_CONTROL_ENABLED
+
+# Structured logging configuration: JSON lines, written to disk by a listener thread.
+# Every gunicorn worker appends to the same file, so rotation is left to logrotate (or
+# similar): the file is reopened when it's moved away, e.g.
+#   /srv/eshop/logs/eshop.log { size 10M  rotate 5  compress  delaycompress  missingok }
+LOG_FILE = os.environ.get('LOG_FILE', os.path.join('logs', 'eshop.log'))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Fast successful requests are sampled; errors and slow requests are always logged
+LOG_SUCCESS_SAMPLE_RATE = float(os.environ.get('LOG_SUCCESS_SAMPLE_RATE', 0.1))
+LOG_SLOW_REQUEST_MS = 500
+
+app.config['LOG_SUCCESS_SAMPLE_RATE'] = LOG_SUCCESS_SAMPLE_RATE
+
+# Assets every full page needs, announced with Link: rel=preload so the browser fetches them
+# alongside the HTML. A front-end server that supports it (nginx early_hints, most CDNs)
+# turns these headers into a 103 Early Hints response; WSGI itself can't send 1xx responses.
+STYLESHEETS = ('base.css', 'header.css', 'footer.css', 'utilities.css', 'forms.css',
+               'products.css', 'product-detail.css', 'cart.css', 'admin.css')
+PRELOAD_SCRIPTS = ('base.js',)
+PRELOAD_IMAGES = 4  # first product images on the catalog page
+
+# Template caching configuration
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR', 'jinja_cache')
+FRAGMENT_CACHE_MAX_ENTRIES = 5000
+
+# Streamed pages are flushed in chunks of roughly this many characters
+STREAM_BUFFER_SIZE = 8192
+
+# Response compression configuration
+COMPRESS_ENABLED = os.environ.get('COMPRESS', '1') == '1'
+COMPRESS_MIN_SIZE = 1024  # bytes
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESS_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'text/javascript',
+                      'application/javascript', 'application/json', 'image/svg+xml'}
+
+app.config['COMPRESS_ENABLED'] = COMPRESS_ENABLED
+app.config['COMPRESS_GZIP_LEVEL'] = COMPRESS_GZIP_LEVEL
+app.config['COMPRESS_BROTLI_QUALITY'] = COMPRESS_BROTLI_QUALITY
+
+# Slow query log configuration
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_MAX_FINGERPRINTS = 200
+SLOW_PLAN_MARKERS = ('SCAN', 'USE TEMP B-TREE')
+
+app.config['SLOW_QUERY_MS'] = SLOW_QUERY_MS
+
+# On-demand profiling configuration
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_RING_SIZE = 20
+PROFILE_TOKEN_MAX_AGE = 600  # 10 minutes
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 15
+
+# Metrics storage (per process, shared with the other workers through METRICS_DIR)
+metrics_lock = threading.Lock()
+metrics_flushed = {'at': 0.0}
+request_latency = {}  # endpoint -> {'buckets': [...], 'sum': float, 'count': int}
+request_status = {}   # (endpoint, method, status) -> count
+sql_totals = {}       # endpoint -> {'queries': int, 'seconds': float, 'rows': int}
+
+# Slow query storage (per process), keyed by query fingerprint
+slow_queries_lock = threading.Lock()
+slow_queries = {}
+
+# Catalog version shared by all worker processes: triggers on products log each changed
+# product_id in catalog_changes, and the version is the newest change_id. Each process polls
+# PRAGMA data_version on its own connection so the log is only read after some commit, and
+# every cache catches up by re-reading or evicting just the products changed since its version.
+CATALOG_CHANGES_KEEP = 10000   # change rows kept; caches further behind than this reload fully
+CATALOG_PATCH_MAX_PRODUCTS = 1000  # above this many changed products a full reload is cheaper
+catalog_version = 0
+catalog_version_lock = threading.Lock()
+catalog_watch = {'pid': None, 'conn': None, 'data_version': None}
+CATALOG_VERSION_SKIP_ENDPOINTS = {'static', 'serve_upload', 'favicon', 'health', 'metrics'}
+
+# Rendered HTML fragments (per process), keyed by (kind, product_id)
+fragment_cache = {}
+fragment_cache_version = 0
+fragment_cache_lock = threading.Lock()
+
+# One backup at a time across all processes: threads of this process take backup_lock,
+# other processes are kept out by an exclusive flock on BACKUP_DIR/backup.lock. The outcome
+# of the latest backup is kept in BACKUP_DIR/status.json so every worker can show it.
+backup_lock = threading.Lock()
+
+# Only one request is profiled at a time since tracemalloc is process-wide
+profile_lock = threading.Lock()
+
+def get_image_url(image_url):
+    if not image_url:
+        return url_for('static', filename='images/placeholder.png')
+    
+    # If it starts with uploads/, it's a local file
+    if image_url.startswith('uploads/'):
+        return url_for('serve_upload', filename=image_url[len('uploads/'):])
+    
+    # Otherwise, it's an external URL
+    return image_url
+
+def sync_catalog_version():
+    """Pick up product changes committed by any process and return the current catalog version"""
+    global catalog_version
+    with catalog_version_lock:
+        # Connections must not cross a fork, so each worker opens its own
+        if catalog_watch['pid'] != os.getpid():
+            catalog_watch.update(pid=os.getpid(), data_version=None,
+                                 conn=sqlite3.connect(app.config['DATABASE'], check_same_thread=False))
+        conn = catalog_watch['conn']
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != catalog_watch['data_version']:
+            catalog_version = conn.execute("SELECT COALESCE(MAX(change_id), 0) FROM catalog_changes").fetchone()[0]
+            # Only remembered once the read succeeded, so a failed read is retried next request
+            catalog_watch['data_version'] = data_version
+        return catalog_version
+
+def catalog_changes_since(version):
+    """Return (product_ids changed after version, newest change_id); product_ids is None when
+    the change log no longer reaches back that far or so much changed that a reload is cheaper"""
+    with get_cursor() as cur:
+        # Separate subqueries so each is answered from the end of the primary key index
+        cur.execute("SELECT (SELECT MIN(change_id) FROM catalog_changes), (SELECT MAX(change_id) FROM catalog_changes)")
+        oldest, newest = cur.fetchone()
+        if newest is None or newest <= version:
+            return set(), version
+        if oldest > version + 1:
+            return None, newest
+        cur.execute("SELECT DISTINCT product_id FROM catalog_changes WHERE change_id > ? AND change_id <= ?",
+                    (version, newest))
+        product_ids = {row[0] for row in cur.fetchall()}
+    if len(product_ids) > CATALOG_PATCH_MAX_PRODUCTS:
+        return None, newest
+    return product_ids, newest
+
+def cached_fragment(key, render):
+    """Return cached HTML for key, a (kind, product_id) pair, rendering it on a miss
+
+    Entries for changed products are evicted as the catalog version moves. A fragment rendered
+    by a request that started before the latest eviction may come from stale rows, so it is
+    returned but not stored.
+    """
+    global fragment_cache_version
+    if fragment_cache_version != catalog_version:
+        with fragment_cache_lock:
+            if fragment_cache_version != catalog_version:
+                changed, version = catalog_changes_since(fragment_cache_version)
+                if changed is None:
+                    fragment_cache.clear()
+                else:
+                    for stale_key in [k for k in fragment_cache if k[1] in changed]:
+                        fragment_cache.pop(stale_key, None)
+                fragment_cache_version = version
+    
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(render())
+        if g.get('_catalog_version', fragment_cache_version) >= fragment_cache_version:
+            if len(fragment_cache) >= FRAGMENT_CACHE_MAX_ENTRIES:
+                fragment_cache.clear()
+            fragment_cache[key] = html
+    return html
+
+app.jinja_env.globals['stylesheets'] = STYLESHEETS
+
+def preload_images(urls):
+    """Ask for Link preload headers for images the page shows first"""
+    g._preload_images = list(urls)
+
+@app.after_request
+def add_preload_links(response):
+    """Announce stylesheets, scripts and the first product images of full HTML pages"""
+    if response.status_code != 200 or response.mimetype != 'text/html' or g.get('_partial'):
+        return response
+    
+    links = [f'<{url_for("static", filename="css/" + name)}>; rel=preload; as=style' for name in STYLESHEETS]
+    links += [f'<{url_for("static", filename="js/" + name)}>; rel=preload; as=script' for name in PRELOAD_SCRIPTS]
+    links += [f'<{url}>; rel=preload; as=image' for url in g.get('_preload_images', ())]
+    response.headers.add('Link', ', '.join(links))
+    return response
+
+@app.template_global()
+def product_card(product):
+    """Render the product card partial, cached per product and catalog version"""
+    return cached_fragment(
+        ('product_card', product['product_id']),
+        lambda: app.jinja_env.get_template('product_card.html').render(
+            product=product, get_image_url=get_image_url)
+    )
+
 @app.context_processor
 def utility_processor():
-    def get_image_url(image_url):
-        if not image_url:
-            return url_for('static', filename='images/placeholder.png')
-        
-        # If it starts with uploads/, it's a local file
-        if image_url.startswith('uploads/'):
-            return url_for('static', filename=image_url)
-        
-        # Otherwise, it's an external URL
-        return image_url
+    # Fragments have no header, so skip the category lookup
+    if g.get('_partial'):
+        return dict(get_image_url=get_image_url)
     
     # Get categories for header dropdown
     categories = []
     try:
+        engine = get_catalog_engine() if app.config.get('CATALOG_ENGINE') else None
+        if engine is not None:
+            return dict(get_image_url=get_image_url, global_categories=engine.categories)
         with get_cursor() as cur:
             cur.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != '' ORDER BY category")
             categories = [row[0] for row in cur.fetchall()]
-    except:
-        pass
+    except Exception:
+        app.logger.exception("Error loading header categories")
     
     return dict(get_image_url=get_image_url, global_categories=categories)
 
-# Ensure upload directory exists when module is imported
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object; fields passed as extra={'fields': {...}} are merged in"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Request and job records; the app logger carries errors
+access_logger = logging.getLogger('eshop.access')
+job_logger = logging.getLogger('eshop.jobs')
+
+log_state = {'handler': None, 'listener': None, 'pid': None}
+
+def start_log_listener():
+    """Start the thread that drains the log queue to the log file"""
+    # Appends from several processes interleave whole lines; renaming the file from
+    # inside one of them would not, so this handler never rotates, it only reopens
+    file_handler = logging.handlers.WatchedFileHandler(LOG_FILE, encoding='utf-8', delay=True)
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(log_state['handler'].queue, file_handler)
+    listener.start()
+    log_state.update(listener=listener, pid=os.getpid())
+
+def configure_logging():
+    """Route app, access and job logs through a queue so disk writes stay off request threads"""
+    if log_state['handler'] is not None:
+        return
+    
+    log_dir = os.path.dirname(LOG_FILE)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    
+    # Records are formatted on the calling thread, so the listener only writes lines
+    handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    handler.setFormatter(JsonFormatter())
+    log_state['handler'] = handler
+    
+    # Flask attaches a stderr handler to app.logger; it would still write on the request thread
+    app.logger.removeHandler(default_handler)
+    for logger in (app.logger, logging.getLogger('eshop')):
+        logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+    logging.getLogger('eshop').propagate = False
+    
+    start_log_listener()
+    atexit.register(lambda: log_state['listener'].stop())
+    # Threads do not survive fork, so each gunicorn worker starts its own listener
+    os.register_at_fork(after_in_child=start_log_listener)
+
+def log_job(name, started, **fields):
+    """Record a finished background job with its duration and report fields"""
+    configure_logging()
+    fields.update(job=name, duration_ms=round((time.perf_counter() - started) * 1000, 2))
+    job_logger.info("Job %s finished", name, extra={'fields': fields})
+
+def log_sql_error(sql, error):
+    app.logger.error("SQL error: %s", error, extra={'fields': {
+        'sql': normalize_sql(sql),
+        'endpoint': request.endpoint if has_request_context() else None,
+    }})
+
+def get_sql_stats():
+    """Get SQL counters for the current request"""
+    stats = getattr(g, '_sql_stats', None)
+    if stats is None:
+        stats = g._sql_stats = {'queries': 0, 'seconds': 0.0, 'rows': 0}
+    return stats
+
+def normalize_sql(sql):
+    """Replace literals with placeholders and collapse IN lists and whitespace"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', sql)
+    return ' '.join(sql.split())
+
+def describe_params(parameters):
+    """Describe the shape of query parameters without their values"""
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(sorted(parameters)) + '}'
+    types = [type(p).__name__ for p in parameters]
+    if len(types) > 6:
+        return f"({len(types)} params: {', '.join(sorted(set(types)))})"
+    return '(' + ', '.join(types) + ')'
+
+def record_slow_query(connection, sql, parameters, duration):
+    """Capture EXPLAIN QUERY PLAN for a slow statement and aggregate it by fingerprint"""
+    normalized = normalize_sql(sql)
+    fingerprint = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+    
+    plan = []
+    if normalized.split(' ', 1)[0].upper() in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+        try:
+            # Plain cursor so the EXPLAIN itself isn't instrumented
+            explain = sqlite3.Cursor(connection)
+            explain.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            plan = [row[3] for row in explain.fetchall()]
+            explain.close()
+        except sqlite3.Error:
+            pass
+    flags = sorted({marker for marker in SLOW_PLAN_MARKERS for step in plan if marker in step})
+    duration_ms = duration * 1000
+    
+    with slow_queries_lock:
+        entry = slow_queries.get(fingerprint)
+        if entry is None:
+            if len(slow_queries) >= SLOW_QUERY_MAX_FINGERPRINTS:
+                # Evict the least expensive fingerprint to keep the log bounded
+                cheapest = min(slow_queries, key=lambda key: slow_queries[key]['total_ms'])
+                del slow_queries[cheapest]
+            entry = slow_queries[fingerprint] = {
+                'fingerprint': fingerprint,
+                'sql': normalized,
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+            }
+        entry['count'] += 1
+        entry['total_ms'] += duration_ms
+        entry['max_ms'] = max(entry['max_ms'], duration_ms)
+        entry['params'] = describe_params(parameters)
+        entry['plan'] = plan
+        entry['flags'] = flags
+        entry['endpoint'] = request.endpoint if has_request_context() else None
+        entry['last_seen'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    
+    app.logger.warning("Slow query %s (%.1f ms, params %s, plan %s): %s",
+                       fingerprint, duration_ms, entry['params'], ' | '.join(plan) or '-', normalized)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records query count, SQL time and rows returned for the current request"""
+
+    def _record(self, started, queries=0, rows=0):
+        stats = get_sql_stats()
+        stats['queries'] += queries
+        stats['rows'] += rows
+        stats['seconds'] += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.Error as e:
+            log_sql_error(sql, e)
+            raise
+        finally:
+            self._record(started, queries=1)
+            duration = time.perf_counter() - started
+            if duration * 1000 >= app.config['SLOW_QUERY_MS']:
+                record_slow_query(self.connection, sql, parameters, duration)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error as e:
+            log_sql_error(sql, e)
+            raise
+        finally:
+            self._record(started, queries=1)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._record(started, rows=0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(started, rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._record(started, rows=len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._record(started, rows=1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including connection.execute) are instrumented"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
 def get_db():
     """Get database connection"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+        db = g._database = sqlite3.connect(app.config['DATABASE'], factory=InstrumentedConnection)
         db.row_factory = sqlite3.Row
     return db
 
+def attach_archive(db, create=False):
+    """Attach the order archive as schema 'archive'; returns False if there is no archive yet"""
+    if getattr(g, '_archive_attached', False):
+        return True
+    
+    path = app.config['ARCHIVE_DATABASE']
+    if not create and not os.path.exists(path):
+        return False
+    
+    db.execute("ATTACH DATABASE ? AS archive", (path,))
+    if create:
+        # Same reason as the main database: streamed archive pages must not block the archiver
+        db.execute("PRAGMA archive.journal_mode=WAL")
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archive.orders(
+            order_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            total DECIMAL(10, 2) NOT NULL,
+            status TEXT,
+            created_at TIMESTAMP
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archive.order_items(
+            item_id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            price_at_purchase DECIMAL(10, 2) NOT NULL
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS archive.idx_orders_user ON orders(user_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS archive.idx_order_items_order ON order_items(order_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS archive.idx_order_items_product ON order_items(product_id)')
+    db.commit()
+    
+    g._archive_attached = True
+    return True
+
 @app.teardown_appcontext
 def close_connection(exception):
     """Close database connection at the end of request"""
@@ -85,6 +663,537 @@ def get_cursor():
     finally:
         cursor.close()
 
+@app.before_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+
+@app.before_request
+def check_catalog_version():
+    # Static files and probes never render catalog fragments, and /health must report a
+    # broken database itself rather than fail here
+    if request.endpoint in CATALOG_VERSION_SKIP_ENDPOINTS:
+        return
+    # Remembered so fragments rendered from this request's reads are never cached as newer
+    try:
+        g._catalog_version = sync_catalog_version()
+    except sqlite3.Error as e:
+        app.logger.warning("Could not check the catalog version: %s", e)
+        g._catalog_version = catalog_version
+
+class AdmissionGate:
+    """Bounded concurrency for one route class: a fixed number of slots plus a short wait queue"""
+
+    def __init__(self, max_in_flight, max_queue, timeout, overflow=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.overflow = overflow  # gate a request must also get a slot from while it waits
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed; False if the queue is full or the wait times out"""
+        with self._cond:
+            if self.in_flight >= self.max_in_flight:
+                if self.queued >= self.max_queue or (self.overflow and not self.overflow.acquire()):
+                    self.rejected += 1
+                    return False
+                self.queued += 1
+                try:
+                    admitted = self._cond.wait_for(lambda: self.in_flight < self.max_in_flight, self.timeout)
+                finally:
+                    self.queued -= 1
+                    if self.overflow:
+                        self.overflow.release()
+                if not admitted:
+                    self.rejected += 1
+                    return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+# No queue of its own: when the shared threads are all taken, the request is shed at once
+shared_gate = AdmissionGate(ADMISSION_SHARED_THREADS, 0, 0)
+admission_gates = {
+    name: AdmissionGate(*limits, overflow=shared_gate if name in ADMISSION_RESERVED_CLASSES else None)
+    for name, limits in ADMISSION_CLASSES.items()
+}
+admission_gates['shared'] = shared_gate
+
+def route_class():
+    """Admission class of the current request, or None for static files, health and metrics"""
+    if request.path.startswith('/admin/'):
+        return 'admin'
+    return ADMISSION_ROUTES.get(request.endpoint)
+
+@app.before_request
+def admit_request():
+    if not app.config.get('ADMISSION_CONTROL'):
+        return
+    name = route_class()
+    if name is None:
+        return
+    
+    gates = [admission_gates[name]]
+    if name not in ADMISSION_RESERVED_CLASSES:
+        gates.insert(0, shared_gate)
+    g._admission_gates = []
+    for gate in gates:
+        if not gate.acquire():
+            response = Response('Server busy, please retry shortly.', status=503, mimetype='text/plain')
+            response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+            return response
+        g._admission_gates.append(gate)
+
+@app.teardown_request
+def release_admission(exception):
+    for gate in g.pop('_admission_gates', []):
+        gate.release()
+
+@app.after_request
+def record_request_metrics(response):
+    """Record route latency, status counts and SQL totals, and add Server-Timing if enabled"""
+    started = getattr(g, '_request_started', None)
+    if started is None:
+        return response
+    
+    duration = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    stats = get_sql_stats()
+    
+    with metrics_lock:
+        latency = request_latency.setdefault(
+            endpoint, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                latency['buckets'][i] += 1
+        latency['sum'] += duration
+        latency['count'] += 1
+        
+        key = (endpoint, request.method, response.status_code)
+        request_status[key] = request_status.get(key, 0) + 1
+        
+        totals = sql_totals.setdefault(endpoint, {'queries': 0, 'seconds': 0.0, 'rows': 0})
+        totals['queries'] += stats['queries']
+        totals['seconds'] += stats['seconds']
+        totals['rows'] += stats['rows']
+    
+    try:
+        flush_metrics()
+    except OSError as e:
+        app.logger.warning("Could not write metrics snapshot: %s", e)
+    
+    if app.config.get('SERVER_TIMING'):
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats["seconds"] * 1000:.2f};desc="{stats["queries"]} queries, {stats["rows"]} rows", '
+            f'app;dur={duration * 1000:.2f}'
+        )
+    return response
+
+@app.after_request
+def log_request(response):
+    """Write an access log record; fast successful requests are sampled"""
+    started = getattr(g, '_request_started', None)
+    if started is None:
+        return response
+    
+    duration_ms = (time.perf_counter() - started) * 1000
+    status = response.status_code
+    sample_rate = app.config['LOG_SUCCESS_SAMPLE_RATE']
+    if status < 400 and duration_ms < LOG_SLOW_REQUEST_MS and random.random() >= sample_rate:
+        return response
+    
+    stats = get_sql_stats()
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': status,
+        'duration_ms': round(duration_ms, 2),
+        'sql_queries': stats['queries'],
+        'sql_ms': round(stats['seconds'] * 1000, 2),
+        'remote_addr': request.remote_addr,
+    }
+    if status < 400 and duration_ms < LOG_SLOW_REQUEST_MS:
+        # Lets log queries scale sampled counts back up
+        fields['sample_rate'] = sample_rate
+    level = logging.ERROR if status >= 500 else logging.WARNING if status >= 400 else logging.INFO
+    access_logger.log(level, "%s %s %s", request.method, request.path, status, extra={'fields': fields})
+    return response
+
+def get_profile_serializer():
+    return URLSafeTimedSerializer(app.secret_key, salt='request-profile')
+
+def profile_requested():
+    """Check for a valid signed profiling token in the X-Profile-Token header or _profile query flag"""
+    token = request.headers.get('X-Profile-Token') or request.args.get('_profile')
+    if not token:
+        return False
+    try:
+        get_profile_serializer().loads(token, max_age=PROFILE_TOKEN_MAX_AGE)
+        return True
+    except BadSignature:
+        return False
+
+@app.before_request
+def start_request_profile():
+    if not profile_requested() or not profile_lock.acquire(blocking=False):
+        return
+    g._profiling = True
+    g._profiler = cProfile.Profile()
+    tracemalloc.start(10)
+    g._profiler.enable()
+
+def save_request_profile(profiler, snapshot, duration, status_code):
+    """Write a profile to the on-disk ring, dropping the oldest ones"""
+    stats = pstats.Stats(profiler)
+    functions = []
+    for func, (cc, ncalls, tottime, cumtime, callers) in stats.stats.items():
+        functions.append({
+            'function': pstats.func_std_string(func),
+            'ncalls': ncalls,
+            'tottime': tottime,
+            'cumtime': cumtime,
+            'callers': sorted((pstats.func_std_string(caller) for caller in callers))[:5],
+        })
+    functions.sort(key=lambda item: item['cumtime'], reverse=True)
+    
+    allocations = [{
+        'location': str(stat.traceback[0]),
+        'size_kb': stat.size / 1024,
+        'count': stat.count,
+    } for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]]
+    
+    # The _profile token is a credential, so it's left out of the stored path
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != '_profile']
+    profile_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:6]}"
+    profile = {
+        'id': profile_id,
+        'method': request.method,
+        'path': request.path + ('?' + urlencode(args) if args else ''),
+        'endpoint': request.endpoint,
+        'status': status_code,
+        'duration_ms': duration * 1000,
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'functions': functions[:PROFILE_TOP_FUNCTIONS],
+        'allocations': allocations,
+    }
+    
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, f"profile_{profile_id}.json"), 'w') as f:
+        json.dump(profile, f)
+    
+    for old_profile in list_profiles()[PROFILE_RING_SIZE:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, f"profile_{old_profile}.json"))
+        except OSError:
+            pass
+
+def list_profiles():
+    """Return stored profile ids, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    ids = [name[len('profile_'):-len('.json')] for name in os.listdir(PROFILE_DIR)
+           if name.startswith('profile_') and name.endswith('.json')]
+    return sorted(ids, reverse=True)
+
+def load_profile(profile_id):
+    if profile_id not in list_profiles():
+        return None
+    with open(os.path.join(PROFILE_DIR, f"profile_{profile_id}.json")) as f:
+        return json.load(f)
+
+@app.after_request
+def note_profile_status(response):
+    # Streamed pages render after this point, so the profile itself is saved at teardown
+    if g.get('_profiling'):
+        g._profile_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_profile(exception):
+    """Save the profile once the response body is complete, then stop tracing and free the slot
+
+    Teardown runs after a streamed body has been sent, and also when the request raised.
+    """
+    if not g.pop('_profiling', False):
+        return
+    profiler = g.pop('_profiler')
+    try:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        duration = time.perf_counter() - g._request_started
+        save_request_profile(profiler, snapshot, duration, g.pop('_profile_status', 500))
+    except Exception as e:
+        app.logger.error("Error saving request profile: %s", e)
+    finally:
+        tracemalloc.stop()
+        profile_lock.release()
+
+def metrics_snapshot():
+    """This process's metrics as plain data, in the format shared through METRICS_DIR"""
+    with metrics_lock:
+        snapshot = {
+            'pid': os.getpid(),
+            'status': [[endpoint, method, status, count]
+                       for (endpoint, method, status), count in request_status.items()],
+            'latency': copy.deepcopy(request_latency),
+            'sql': copy.deepcopy(sql_totals),
+        }
+    snapshot['admission'] = {
+        name: {field: getattr(gate, field) for field in ('in_flight', 'queued', 'admitted', 'rejected')}
+        for name, gate in admission_gates.items()
+    }
+    with slow_queries_lock:
+        snapshot['slow_queries'] = [dict(entry) for entry in slow_queries.values()]
+    return snapshot
+
+def flush_metrics(force=False):
+    """Write this process's snapshot for the other workers, at most every METRICS_FLUSH_INTERVAL"""
+    now = time.monotonic()
+    if not force and now - metrics_flushed['at'] < METRICS_FLUSH_INTERVAL:
+        return
+    metrics_flushed['at'] = now
+    
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics_snapshot(), f)
+    os.replace(temp_path, path)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def prune_metrics_snapshots():
+    """Remove snapshots left by processes that are gone, e.g. from a previous server run"""
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        pid = name.split('.', 1)[0]
+        if pid.isdigit() and not process_alive(int(pid)):
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except OSError:
+                pass
+
+def collect_metrics():
+    """This process's live metrics added to the latest snapshot of every other worker"""
+    snapshots = [metrics_snapshot()]
+    own_file = f"{snapshots[0]['pid']}.json"
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith('.json') or name == own_file:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name), encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not process_alive(snapshot['pid']):
+            # A recycled worker's counters still count, its gauges don't
+            for gate in snapshot['admission'].values():
+                gate['in_flight'] = gate['queued'] = 0
+        snapshots.append(snapshot)
+    
+    merged = {'workers': len(snapshots), 'status': {}, 'latency': {}, 'sql': {},
+              'admission': {}, 'slow_queries': {}}
+    for snapshot in snapshots:
+        for endpoint, method, status, count in snapshot['status']:
+            key = (endpoint, method, status)
+            merged['status'][key] = merged['status'].get(key, 0) + count
+        for endpoint, latency in snapshot['latency'].items():
+            total = merged['latency'].setdefault(
+                endpoint, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], latency['buckets'])]
+            total['sum'] += latency['sum']
+            total['count'] += latency['count']
+        for endpoint, totals in snapshot['sql'].items():
+            total = merged['sql'].setdefault(endpoint, {'queries': 0, 'seconds': 0.0, 'rows': 0})
+            for field in total:
+                total[field] += totals[field]
+        for name, gate in snapshot['admission'].items():
+            total = merged['admission'].setdefault(name, dict.fromkeys(gate, 0))
+            for field in total:
+                total[field] += gate[field]
+        for entry in snapshot['slow_queries']:
+            total = merged['slow_queries'].get(entry['fingerprint'])
+            if total is None:
+                merged['slow_queries'][entry['fingerprint']] = dict(entry)
+                continue
+            # Plan, params and endpoint come from the most recent sighting
+            latest = entry if entry['last_seen'] > total['last_seen'] else total
+            merged['slow_queries'][entry['fingerprint']] = dict(
+                latest,
+                count=total['count'] + entry['count'],
+                total_ms=total['total_ms'] + entry['total_ms'],
+                max_ms=max(total['max_ms'], entry['max_ms']),
+            )
+    return merged
+
+def render_metrics():
+    """Render metrics summed over all worker processes in Prometheus text exposition format"""
+    lines = []
+    metrics = collect_metrics()
+    
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+    
+    lines.append('# HELP eshop_metrics_workers Worker processes whose metrics are included.')
+    lines.append('# TYPE eshop_metrics_workers gauge')
+    lines.append(f"eshop_metrics_workers {metrics['workers']}")
+    
+    lines.append('# HELP eshop_http_requests_total Total HTTP requests by endpoint, method and status.')
+    lines.append('# TYPE eshop_http_requests_total counter')
+    for (endpoint, method, status), count in sorted(metrics['status'].items()):
+        lines.append(f'eshop_http_requests_total{{endpoint="{label(endpoint)}",method="{method}",status="{status}"}} {count}')
+    
+    lines.append('# HELP eshop_http_request_duration_seconds Request latency by endpoint.')
+    lines.append('# TYPE eshop_http_request_duration_seconds histogram')
+    for endpoint, latency in sorted(metrics['latency'].items()):
+        name = label(endpoint)
+        for bound, count in zip(LATENCY_BUCKETS, latency['buckets']):
+            lines.append(f'eshop_http_request_duration_seconds_bucket{{endpoint="{name}",le="{bound}"}} {count}')
+        lines.append(f'eshop_http_request_duration_seconds_bucket{{endpoint="{name}",le="+Inf"}} {latency["count"]}')
+        lines.append(f'eshop_http_request_duration_seconds_sum{{endpoint="{name}"}} {latency["sum"]:.6f}')
+        lines.append(f'eshop_http_request_duration_seconds_count{{endpoint="{name}"}} {latency["count"]}')
+    
+    for metric, field, help_text in (
+        ('eshop_sql_queries_total', 'queries', 'SQL statements executed by endpoint.'),
+        ('eshop_sql_seconds_total', 'seconds', 'Time spent in SQLite by endpoint.'),
+        ('eshop_sql_rows_total', 'rows', 'Rows returned from SQLite by endpoint.'),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for endpoint, totals in sorted(metrics['sql'].items()):
+            value = f'{totals[field]:.6f}' if field == 'seconds' else totals[field]
+            lines.append(f'{metric}{{endpoint="{label(endpoint)}"}} {value}')
+    
+    for metric, field, kind, help_text in (
+        ('eshop_admission_in_flight', 'in_flight', 'gauge', 'Requests currently running by route class.'),
+        ('eshop_admission_queue_depth', 'queued', 'gauge', 'Requests waiting for a slot by route class.'),
+        ('eshop_admission_admitted_total', 'admitted', 'counter', 'Requests admitted by route class.'),
+        ('eshop_admission_rejected_total', 'rejected', 'counter', 'Requests shed with 503 by route class.'),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for name, gate in metrics['admission'].items():
+            lines.append(f'{metric}{{class="{name}"}} {gate[field]}')
+    
+    return '\n'.join(lines) + '\n'
+
+class StreamCompressor:
+    """Incremental gzip/brotli compressor with a common interface"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            # wbits=31 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data, flush=False):
+        if self.encoding == 'br':
+            out = self._compressor.process(data)
+            return out + self._compressor.flush() if flush else out
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+def stream_compressed(chunks, encoding):
+    """Compress a streamed body, flushing after each chunk so the client gets bytes promptly"""
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk, flush=True)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+@app.after_request
+def compress_response(response):
+    """Negotiate brotli/gzip for text responses, skipping small bodies and binary files"""
+    if not app.config.get('COMPRESS_ENABLED'):
+        return response
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings)
+    if not encoding:
+        return response
+    
+    if response.is_streamed:
+        response.response = stream_compressed(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressor = StreamCompressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.finish())
+    
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def buffered_stream(chunks, size=STREAM_BUFFER_SIZE):
+    """Join tiny template chunks into larger writes"""
+    buffer = []
+    length = 0
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                yield ''.join(buffer)
+                buffer = []
+                length = 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+def stream_page(template_name, **context):
+    """Render a large list page incrementally so rows never sit in memory all at once"""
+    return Response(buffered_stream(stream_template(template_name, **context)), mimetype='text/html')
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -112,7 +1221,7 @@ def download_image_from_url(url, product_id):
         
         return f"uploads/{filename}"
     except Exception as e:
-        print(f"Error downloading image from URL: {e}")
+        app.logger.warning("Error downloading image from URL %s: %s", url, e)
         return None
 
 def save_uploaded_file(file, product_id):
@@ -141,6 +1250,7 @@ def save_uploaded_file(file, product_id):
             return f"uploads/{filename}"
         return None
     except Exception as e:
+        app.logger.exception("Error processing uploaded image")
         flash(f"Error processing image: {str(e)}", "danger")
         return None
 
@@ -242,12 +1352,23 @@ def rate_limit(key, max_attempts=5, window=900):  # 15 minutes
     login_attempts[key].append(current_time)
     return True
 
+def popularity_weight(sold_at=None):
+    """Weight of one unit sold at sold_at (unix time, default now) in products.popularity"""
+    if sold_at is None:
+        sold_at = time.time()
+    return 2 ** ((sold_at - POPULARITY_EPOCH) / (POPULARITY_HALF_LIFE_DAYS * 86400))
+
 def init_db():
     """Initialize the database with required tables and sample data"""
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(app.config['DATABASE'])
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
+    # WAL lets pages stream from an open cursor while checkout and admin writes commit;
+    # in rollback-journal mode a reader's shared lock blocks every writer until it finishes.
+    # The setting is stored in the database file, so this only has to run once.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Create users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users(
@@ -270,7 +1391,9 @@ def init_db():
             stock_quantity INTEGER NOT NULL DEFAULT 0,
             category VARCHAR(50),
             image_url VARCHAR(255),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            units_sold INTEGER NOT NULL DEFAULT 0,
+            popularity REAL NOT NULL DEFAULT 0
         )
     ''')
     
@@ -299,14 +1422,101 @@ def init_db():
         )
     ''')
     
+    # Databases created before the sales counters existed get them backfilled from past orders
+    cursor.execute("PRAGMA table_info(products)")
+    if 'units_sold' not in {row['name'] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE products ADD COLUMN units_sold INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("ALTER TABLE products ADD COLUMN popularity REAL NOT NULL DEFAULT 0")
+        # Archived orders count too
+        schemas = ['main']
+        if os.path.exists(app.config['ARCHIVE_DATABASE']):
+            conn.commit()  # ATTACH can't run inside a transaction
+            cursor.execute("ATTACH DATABASE ? AS archive", (app.config['ARCHIVE_DATABASE'],))
+            schemas.append('archive')
+        cursor.execute(' UNION ALL '.join(f'''
+            SELECT oi.product_id, oi.quantity, CAST(strftime('%s', o.created_at) AS INTEGER) as sold_at
+            FROM {schema}.order_items oi JOIN {schema}.orders o ON o.order_id = oi.order_id
+        ''' for schema in schemas))
+        rows = cursor.fetchall()
+        if 'archive' in schemas:
+            cursor.execute("DETACH DATABASE archive")
+        sales = {}
+        for row in rows:
+            units, popularity = sales.get(row['product_id'], (0, 0.0))
+            sales[row['product_id']] = (units + row['quantity'],
+                                        popularity + row['quantity'] * popularity_weight(row['sold_at']))
+        cursor.executemany("UPDATE products SET units_sold = ?, popularity = ? WHERE product_id = ?",
+                           [(units, popularity, pid) for pid, (units, popularity) in sales.items()])
+    
     # Create indexes for better performance
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_popularity ON products(popularity DESC, product_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_stock ON products(stock_quantity)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id)')
     
+    # Co-purchase counts and precomputed top-N recommendations (see refresh_recommendations)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_copurchases(
+            product_id INTEGER NOT NULL,
+            related_product_id INTEGER NOT NULL,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, related_product_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_recommendations(
+            product_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            related_product_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (product_id, rank)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recommendations_pending(
+            product_id INTEGER PRIMARY KEY
+        )
+    ''')
+    
+    # Progress markers for incremental background jobs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_state(
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Change log of product ids written by triggers; its newest change_id is the catalog
+    # version each worker process compares its in-memory caches against
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_changes(
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL
+        )
+    ''')
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS products_log_{event.lower()}
+            AFTER {event} ON products
+            BEGIN
+                INSERT INTO catalog_changes (product_id) VALUES ({row}.product_id);
+            END
+        ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS catalog_changes_prune
+        AFTER INSERT ON catalog_changes
+        BEGIN
+            DELETE FROM catalog_changes WHERE change_id <= NEW.change_id - {CATALOG_CHANGES_KEEP};
+        END
+    ''')
+    # Replaced by catalog_changes
+    for event in ('insert', 'update', 'delete'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS products_catalog_version_{event}")
+    cursor.execute("DROP TABLE IF EXISTS catalog_version")
+    
     # Create admin user if it doesn't exist
     admin_password = bcrypt.hashpw('admin123'.encode('utf-8'), bcrypt.gensalt())
     cursor.execute('''
@@ -337,17 +1547,923 @@ def init_db():
     conn.close()
     print("Database initialized successfully!")
 
+def with_schema(f):
+    """Run init_db() before a CLI command; `flask --app app <cmd>` never calls create_app()"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        init_db()
+        return f(*args, **kwargs)
+    return decorated_function
+
+class PrefixIndex:
+    """Sorted array of (term, key) pairs searched with bisect for typeahead suggestions
+
+    A second array keeps every entry ordered by popularity, so prefixes matching more than
+    SUGGEST_SCAN_LIMIT terms are answered by walking best sellers first instead of ranking
+    only the first alphabetical matches.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.version = None
+        self._terms = []
+        self._ranked = []  # (-popularity, label, key)
+        self._entries = {}
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(str(text).lower().split())
+
+    @classmethod
+    def terms_for(cls, label):
+        """The full label plus every suffix starting at a word, so 'mouse' finds 'Wireless Mouse'"""
+        label = cls.normalize(label)
+        terms = {label}
+        for match in re.finditer(r'\s(\S)', label):
+            terms.add(label[match.start(1):])
+        return terms
+
+    @staticmethod
+    def _rank_key(key, entry):
+        return (-entry['popularity'], entry['label'], key)
+
+    def add_many(self, items):
+        """Bulk load (key, label, popularity) items with one sort instead of an insort per term"""
+        with self.lock:
+            for key, label, popularity in items:
+                self._remove(key)
+                self._entries[key] = {'label': label, 'popularity': popularity, 'terms': self.terms_for(label)}
+            self._terms = sorted((term, key) for key, entry in self._entries.items() for term in entry['terms'])
+            self._ranked = sorted(self._rank_key(key, entry) for key, entry in self._entries.items())
+
+    def add(self, key, label, popularity=0):
+        with self.lock:
+            self._remove(key)
+            terms = self.terms_for(label)
+            entry = self._entries[key] = {'label': label, 'popularity': popularity, 'terms': terms}
+            for term in terms:
+                bisect.insort(self._terms, (term, key))
+            bisect.insort(self._ranked, self._rank_key(key, entry))
+
+    def remove(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        for term in entry['terms']:
+            i = bisect.bisect_left(self._terms, (term, key))
+            if i < len(self._terms) and self._terms[i] == (term, key):
+                del self._terms[i]
+        rank_key = self._rank_key(key, entry)
+        i = bisect.bisect_left(self._ranked, rank_key)
+        if i < len(self._ranked) and self._ranked[i] == rank_key:
+            del self._ranked[i]
+        return entry
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def search(self, prefix, limit=SUGGEST_LIMIT):
+        """Return (key, entry) pairs whose terms start with prefix, most popular first"""
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        
+        with self.lock:
+            terms = self._terms
+            lo = bisect.bisect_left(terms, (prefix,))
+            hi = bisect.bisect_left(terms, (prefix + '\uffff',))
+            
+            if hi - lo <= SUGGEST_SCAN_LIMIT:
+                found = {key: self._entries[key] for term, key in terms[lo:hi]}
+                ranked = sorted(found.items(), key=lambda item: self._rank_key(item[0], item[1]))
+                return ranked[:limit]
+            
+            # Many matches: walk entries from most popular down until enough of them match
+            results = []
+            for _, _, key in self._ranked:
+                entry = self._entries[key]
+                if any(term.startswith(prefix) for term in entry['terms']):
+                    results.append((key, entry))
+                    if len(results) >= limit:
+                        break
+            return results
+
+def parse_price(value):
+    """Parse a price filter, ignoring anything that isn't a number"""
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def query_catalog_sql(cur, search_query='', category='', stock_filter='all', min_price=None,
+                      max_price=None, sort_by='newest', limit=CATALOG_PER_PAGE, offset=0):
+    """Filter, sort and paginate products in SQLite; returns (products, total)"""
+    query = "SELECT * FROM products"
+    count_query = "SELECT COUNT(*) FROM products"
+    params = []
+    conditions = []
+    
+    if search_query:
+        conditions.append("name LIKE ? ESCAPE '\\'")
+        params.append(f'%{search_query.translate(LIKE_ESCAPES)}%')
+    
+    if category:
+        conditions.append("category = ?")
+        params.append(category)
+    
+    # Stock filter
+    if stock_filter == 'in_stock':
+        conditions.append("stock_quantity > 0")
+    elif stock_filter == 'out_of_stock':
+        conditions.append("stock_quantity = 0")
+    # 'all' shows everything, so no condition needed
+    
+    # Price range filtering
+    if min_price is not None:
+        conditions.append("price >= ?")
+        params.append(min_price)
+    
+    if max_price is not None:
+        conditions.append("price <= ?")
+        params.append(max_price)
+    
+    if conditions:
+        where_clause = " WHERE " + " AND ".join(conditions)
+        query += where_clause
+        count_query += where_clause
+    
+    # Get total count
+    cur.execute(count_query, params)
+    total = cur.fetchone()[0]
+    
+    # Add sorting
+    column, descending = CATALOG_SORTS.get(sort_by, CATALOG_SORTS['newest'])
+    sort_clause = f"{column} {'DESC' if descending else 'ASC'}, product_id ASC"
+    
+    # Get products with pagination
+    query += f" ORDER BY {sort_clause} LIMIT ? OFFSET ?"
+    cur.execute(query, params + [limit, offset])
+    return cur.fetchall(), total
+
+class CatalogEngine:
+    """Columnar, read-only copy of the products table answering home()'s queries in memory
+
+    Filters are row bitsets (Python ints) combined with &, and each sort order is a
+    presorted permutation of row numbers, so a query is a mask plus a walk down one permutation.
+    """
+
+    def __init__(self, rows, version=0):
+        self.rows = rows
+        self.version = version
+        n = len(rows)
+        self.size = n
+        self.row_of = {row['product_id']: i for i, row in enumerate(rows)}
+        self.all_mask = (1 << n) - 1
+        
+        self.price = array('d', (float(row['price']) for row in rows))
+        self.stock = array('q', (row['stock_quantity'] for row in rows))
+        self.names = [row['name'].translate(ASCII_LOWER) for row in rows]
+        
+        # Category codes and per-category bitsets
+        self.categories = sorted({row['category'] for row in rows if row['category']})
+        codes = {name: code for code, name in enumerate(self.categories)}
+        self.category_code = array('l', (codes.get(row['category'], -1) for row in rows))
+        self.category_masks = {}
+        for category, code in codes.items():
+            self.category_masks[category] = self._mask(i for i in range(n) if self.category_code[i] == code)
+        
+        self.in_stock_mask = self._mask(i for i in range(n) if self.stock[i] > 0)
+        self.out_of_stock_mask = self._mask(i for i in range(n) if self.stock[i] == 0)
+        
+        # One permutation per sort order, ties broken by product_id like the SQL path
+        by_id = sorted(range(n), key=lambda i: rows[i]['product_id'])
+        sort_keys = {
+            'created_at': lambda i: rows[i]['created_at'] or '',
+            'price': lambda i: self.price[i],
+            'name': lambda i: rows[i]['name'],
+            'popularity': lambda i: rows[i]['popularity'],
+        }
+        self.permutations = {}
+        for sort_by, (column, descending) in CATALOG_SORTS.items():
+            self.permutations[sort_by] = array('l', sorted(by_id, key=sort_keys[column], reverse=descending))
+        
+        # Prices in ascending order, for bisecting price ranges
+        self.sorted_prices = array('d', (self.price[i] for i in self.permutations['price_low']))
+
+    def with_changes(self, rows, product_ids, version):
+        """Return a copy with new stock and sales counters for the changed products applied, or
+        None when a product was added, deleted or had a filtered or sorted column changed"""
+        changed = {}
+        for row in rows:
+            i = self.row_of.get(row['product_id'])
+            if i is None:
+                return None
+            old = self.rows[i]
+            if any(old[column] != row[column] for column in ('name', 'category', 'price', 'created_at')):
+                return None
+            changed[i] = row
+        if len(changed) != len(product_ids):
+            return None  # some were deleted
+        
+        engine = copy.copy(self)
+        engine.rows = list(self.rows)
+        engine.stock = array('q', self.stock)
+        engine.version = version
+        resorted = [i for i, row in changed.items() if row['popularity'] != self.rows[i]['popularity']]
+        for i, row in changed.items():
+            engine.rows[i] = row
+            engine.stock[i] = row['stock_quantity']
+            bit = 1 << i
+            engine.in_stock_mask = engine.in_stock_mask | bit if row['stock_quantity'] > 0 else engine.in_stock_mask & ~bit
+            engine.out_of_stock_mask = engine.out_of_stock_mask | bit if row['stock_quantity'] == 0 else engine.out_of_stock_mask & ~bit
+        
+        if resorted:
+            # Pull the changed rows out of the popularity order, then bisect them back in
+            engine.permutations = dict(self.permutations)
+            moved = set(resorted)
+            permutation = array('l', (i for i in self.permutations['popular'] if i not in moved))
+            key = lambda i: (-engine.rows[i]['popularity'], engine.rows[i]['product_id'])
+            for i in resorted:
+                permutation.insert(bisect.bisect_right(permutation, key(i), key=key), i)
+            engine.permutations['popular'] = permutation
+        return engine
+
+    def _mask(self, row_numbers):
+        bits = bytearray((self.size + 7) // 8)
+        for i in row_numbers:
+            bits[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bits, 'little')
+
+    def query(self, search_query='', category='', stock_filter='all', min_price=None,
+              max_price=None, sort_by='newest', limit=CATALOG_PER_PAGE, offset=0):
+        """Same contract as query_catalog_sql(); returns (products, total)"""
+        mask = self.all_mask
+        
+        if search_query:
+            needle = search_query.translate(ASCII_LOWER)
+            mask &= self._mask(i for i, name in enumerate(self.names) if needle in name)
+        
+        if category:
+            mask &= self.category_masks.get(category, 0)
+        
+        if stock_filter == 'in_stock':
+            mask &= self.in_stock_mask
+        elif stock_filter == 'out_of_stock':
+            mask &= self.out_of_stock_mask
+        
+        if min_price is not None or max_price is not None:
+            lo = bisect.bisect_left(self.sorted_prices, min_price) if min_price is not None else 0
+            hi = bisect.bisect_right(self.sorted_prices, max_price) if max_price is not None else self.size
+            mask &= self._mask(self.permutations['price_low'][lo:hi])
+        
+        total = mask.bit_count()
+        permutation = self.permutations.get(sort_by, self.permutations['newest'])
+        
+        if mask == self.all_mask:
+            return [self.rows[i] for i in permutation[offset:offset + limit]], total
+        
+        bits = mask.to_bytes((self.size + 7) // 8, 'little')
+        products = []
+        skipped = 0
+        for i in permutation:
+            if bits[i >> 3] >> (i & 7) & 1:
+                if skipped < offset:
+                    skipped += 1
+                    continue
+                products.append(self.rows[i])
+                if len(products) >= limit:
+                    break
+        return products, total
+
+# Stock and sales changes are patched in; anything else rebuilds it on a background thread
+catalog_engine = None
+catalog_engine_lock = threading.Lock()
+catalog_engine_rebuilding = threading.Event()
+
+def load_catalog_engine():
+    """Build the in-memory catalog from the products table"""
+    global catalog_engine
+    with get_cursor() as cur:
+        # Version first: changes committed while reading are simply applied again later
+        cur.execute("SELECT COALESCE(MAX(change_id), 0) FROM catalog_changes")
+        version = cur.fetchone()[0]
+        cur.execute("SELECT * FROM products")
+        rows = cur.fetchall()
+    catalog_engine = CatalogEngine(rows, version)
+    return catalog_engine
+
+def rebuild_catalog_engine():
+    try:
+        with app.app_context():
+            load_catalog_engine()
+    except Exception:
+        app.logger.exception("Error rebuilding catalog engine")
+    finally:
+        catalog_engine_rebuilding.clear()
+
+def get_catalog_engine():
+    """Return the in-memory catalog brought up to the current version, or None while a full
+    rebuild runs in the background (callers then use the SQL path)"""
+    global catalog_engine
+    engine = catalog_engine
+    if engine is not None and engine.version == catalog_version:
+        return engine
+    if catalog_engine_rebuilding.is_set():
+        return None
+    
+    with catalog_engine_lock:
+        engine = catalog_engine
+        if engine is not None and engine.version != catalog_version:
+            changed, version = catalog_changes_since(engine.version)
+            patched = None
+            if changed is not None:
+                with get_cursor() as cur:
+                    ids = list(changed)
+                    cur.execute(f"SELECT * FROM products WHERE product_id IN ({','.join(['?'] * len(ids))})", ids)
+                    patched = engine.with_changes(cur.fetchall(), changed, version) if ids else engine
+            if patched is not None:
+                patched.version = version
+                catalog_engine = engine = patched
+            else:
+                engine = None
+        
+        if engine is None and not catalog_engine_rebuilding.is_set():
+            catalog_engine_rebuilding.set()
+            threading.Thread(target=rebuild_catalog_engine, daemon=True).start()
+    return engine
+
+@app.cli.command('bench-catalog')
+@click.option('--iterations', default=500, show_default=True, help='Random queries to run.')
+@with_schema
+def bench_catalog_command(iterations):
+    """Compare the in-memory catalog engine against the SQL path on random home() queries."""
+    engine = load_catalog_engine()
+    words = sorted({word for name in engine.names for word in name.split()}) or ['']
+    prices = sorted(engine.price) or [0.0]
+    # LIKE wildcards must match literally on both paths
+    terms = [word[:3] for word in words] + ['%', '_', '\\', '1%', 'a_']
+    
+    rng = random.Random(42)
+    cases = []
+    for _ in range(iterations):
+        low = rng.choice(prices) if rng.random() < 0.3 else None
+        cases.append(dict(
+            search_query=rng.choice(terms) if rng.random() < 0.3 else '',
+            category=rng.choice(engine.categories) if engine.categories and rng.random() < 0.3 else '',
+            stock_filter=rng.choice(['all', 'all', 'in_stock', 'out_of_stock']),
+            min_price=low,
+            max_price=low * 2 if low is not None and rng.random() < 0.5 else None,
+            sort_by=rng.choice(list(CATALOG_SORTS)),
+            limit=CATALOG_PER_PAGE,
+            offset=rng.randint(0, 3) * CATALOG_PER_PAGE,
+        ))
+    
+    mismatches = 0
+    sql_time = engine_time = 0.0
+    with get_cursor() as cur:
+        for case in cases:
+            started = time.perf_counter()
+            sql_products, sql_total = query_catalog_sql(cur, **case)
+            sql_time += time.perf_counter() - started
+            
+            started = time.perf_counter()
+            products, total = engine.query(**case)
+            engine_time += time.perf_counter() - started
+            
+            if total != sql_total or [p['product_id'] for p in products] != [p['product_id'] for p in sql_products]:
+                mismatches += 1
+    
+    print(f"{engine.size} products, {iterations} queries")
+    print(f"SQL:    {sql_time / iterations * 1000:.3f} ms/query")
+    print(f"Engine: {engine_time / iterations * 1000:.3f} ms/query")
+    print(f"Result mismatches: {mismatches}")
+
+class SuggestIndex(PrefixIndex):
+    """Prefix index of product names and categories. A category is ranked by the units sold of
+    its products and dropped when its last product is deleted or moved elsewhere."""
+
+    def __init__(self):
+        super().__init__()
+        self.product_categories = {}  # product_id -> (category, units)
+        self.category_totals = {}     # category -> [products, units]
+
+    def load(self, rows):
+        """Bulk load (product_id, name, category, units) rows"""
+        for row in rows:
+            self._count(row['product_id'], row['category'], row['units'])
+        self.add_many([(('product', row['product_id']), row['name'], row['units']) for row in rows] +
+                      [(('category', category), category, units)
+                       for category, (_, units) in self.category_totals.items()])
+
+    def update_products(self, rows_by_id, product_ids):
+        """Re-index the given products from their current rows; a missing row means deleted"""
+        touched = set()
+        for product_id in product_ids:
+            old = self.product_categories.pop(product_id, None)
+            if old is not None and old[0]:
+                totals = self.category_totals[old[0]]
+                totals[0] -= 1
+                totals[1] -= old[1]
+                touched.add(old[0])
+            
+            row = rows_by_id.get(product_id)
+            if row is None:
+                self.remove(('product', product_id))
+                continue
+            entry = self.get(('product', product_id))
+            if entry is None or entry['label'] != row['name'] or entry['popularity'] != row['units']:
+                self.add(('product', product_id), row['name'], row['units'])
+            self._count(product_id, row['category'], row['units'])
+            if row['category']:
+                touched.add(row['category'])
+        
+        for category in touched:
+            products, units = self.category_totals.get(category, (0, 0))
+            if products == 0:
+                self.category_totals.pop(category, None)
+                self.remove(('category', category))
+                continue
+            entry = self.get(('category', category))
+            if entry is None or entry['popularity'] != units:
+                self.add(('category', category), category, units)
+
+    def _count(self, product_id, category, units):
+        self.product_categories[product_id] = (category, units)
+        if category:
+            totals = self.category_totals.setdefault(category, [0, 0])
+            totals[0] += 1
+            totals[1] += units
+
+# Product names and categories for /api/suggest (per process), rebuilt when the catalog version moves
+suggest_index = SuggestIndex()
+suggest_index_lock = threading.Lock()
+
+def load_suggest_index():
+    """Build the suggestion index from the products table, ranked by units sold"""
+    with get_cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(change_id), 0) FROM catalog_changes")
+        version = cur.fetchone()[0]
+        cur.execute("SELECT product_id, name, category, units_sold as units FROM products")
+        rows = cur.fetchall()
+    
+    index = SuggestIndex()
+    index.load(rows)
+    index.loaded = True
+    index.version = version
+    
+    global suggest_index
+    suggest_index = index
+
+def index_products(product_ids):
+    """Re-index changed products in place: renamed, recategorised, deleted or newly sold"""
+    ids = list(product_ids)
+    if not ids:
+        return
+    with get_cursor() as cur:
+        cur.execute(f"""
+            SELECT product_id, name, category, units_sold as units FROM products
+            WHERE product_id IN ({','.join(['?'] * len(ids))})
+        """, ids)
+        rows = {row['product_id']: row for row in cur.fetchall()}
+    suggest_index.update_products(rows, ids)
+
+def get_suggest_index():
+    """Return the suggestion index, catching up on products changed since its version"""
+    if suggest_index.loaded and suggest_index.version == catalog_version:
+        return suggest_index
+    
+    with suggest_index_lock:
+        if not suggest_index.loaded:
+            load_suggest_index()
+        elif suggest_index.version != catalog_version:
+            changed, version = catalog_changes_since(suggest_index.version)
+            if changed is None:
+                load_suggest_index()
+            else:
+                index_products(changed)
+                suggest_index.version = version
+    return suggest_index
+
+def warm_up():
+    """Load templates and caches so forked workers share them copy-on-write"""
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+    
+    with app.app_context():
+        sync_catalog_version()
+        load_suggest_index()
+        if app.config.get('CATALOG_ENGINE'):
+            load_catalog_engine()
+
+def create_app(config=None):
+    """Configure the application, prepare the database and upload folder, and warm caches"""
+    if config:
+        app.config.update(config)
+    
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+    configure_logging()
+    prune_metrics_snapshots()
+    init_db()
+    warm_up()
+    return app
+
+def collect_orphaned_uploads(grace_period=UPLOAD_GC_GRACE_PERIOD, batch_size=UPLOAD_GC_BATCH_SIZE,
+                             pause=UPLOAD_GC_PAUSE, max_files=None, dry_run=False):
+    """Delete uploaded images no product references any more, in small batches"""
+    started = time.perf_counter()
+    with get_cursor() as cur:
+        cur.execute("SELECT image_url FROM products WHERE image_url LIKE 'uploads/%'")
+        referenced = {row[0][len('uploads/'):] for row in cur.fetchall()}
+    
+    # Files younger than the grace period may belong to a product that is still being saved
+    cutoff = time.time() - grace_period
+    report = {'scanned': 0, 'deleted': 0, 'skipped_recent': 0, 'bytes_reclaimed': 0}
+    in_batch = 0
+    
+    with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            report['scanned'] += 1
+            if entry.name in referenced:
+                continue
+            
+            stat = entry.stat()
+            if stat.st_mtime > cutoff:
+                report['skipped_recent'] += 1
+                continue
+            
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+            report['deleted'] += 1
+            report['bytes_reclaimed'] += stat.st_size
+            
+            if max_files and report['deleted'] >= max_files:
+                break
+            in_batch += 1
+            if in_batch >= batch_size:
+                in_batch = 0
+                time.sleep(pause)
+    
+    log_job('gc_uploads', started, dry_run=dry_run, **report)
+    return report
+
+@app.cli.command('gc-uploads')
+@click.option('--grace-hours', default=UPLOAD_GC_GRACE_PERIOD / 3600, show_default=True,
+              help='Only delete files older than this many hours.')
+@click.option('--batch-size', default=UPLOAD_GC_BATCH_SIZE, show_default=True,
+              help='Files deleted between pauses.')
+@click.option('--max-files', default=0, help='Stop after deleting this many files (0 = no limit).')
+@click.option('--dry-run', is_flag=True, help='Report what would be deleted without deleting.')
+@with_schema
+def gc_uploads_command(grace_hours, batch_size, max_files, dry_run):
+    """Delete uploaded images that are no longer referenced by any product."""
+    report = collect_orphaned_uploads(grace_period=grace_hours * 3600, batch_size=batch_size,
+                                      max_files=max_files, dry_run=dry_run)
+    action = 'Would delete' if dry_run else 'Deleted'
+    print(f"Scanned {report['scanned']} files, {action.lower()} {report['deleted']} orphaned "
+          f"({report['bytes_reclaimed'] / 1024:.1f} KB reclaimed), "
+          f"skipped {report['skipped_recent']} inside the grace period")
+
+def refresh_recommendations(rebuild=False, chunk_orders=RECOMMENDATIONS_CHUNK_ORDERS,
+                            top_n=RECOMMENDATIONS_PER_PRODUCT, rank_batch=RECOMMENDATIONS_RANK_BATCH,
+                            pause=RECOMMENDATIONS_PAUSE):
+    """Fold new orders into co-purchase counts, then recompute top-N lists for the products they touch"""
+    started = time.perf_counter()
+    db = get_db()
+    cur = db.cursor()
+    
+    if rebuild:
+        cur.execute("DELETE FROM product_copurchases")
+        cur.execute("DELETE FROM product_recommendations")
+        cur.execute("DELETE FROM recommendations_pending")
+        cur.execute("DELETE FROM job_state WHERE name = 'recommendations_last_order'")
+        db.commit()
+    
+    cur.execute("SELECT value FROM job_state WHERE name = 'recommendations_last_order'")
+    row = cur.fetchone()
+    last_order = row[0] if row else 0
+    cur.execute("SELECT COALESCE(MAX(order_id), 0) FROM orders")
+    max_order = cur.fetchone()[0]
+    
+    # Phase 1: fold orders in short transactions. Touched products are queued in
+    # recommendations_pending, so an interrupted run is finished by the next one.
+    report = {'orders': 0, 'products': 0}
+    while last_order < max_order:
+        upper = min(last_order + chunk_orders, max_order)
+        
+        # Set-based self-join: every pair of distinct products bought in the same order
+        cur.execute("""
+            INSERT INTO product_copurchases (product_id, related_product_id, orders_count)
+            SELECT a.product_id, b.product_id, COUNT(DISTINCT a.order_id)
+            FROM order_items a
+            JOIN order_items b ON b.order_id = a.order_id AND b.product_id != a.product_id
+            JOIN orders o ON o.order_id = a.order_id
+            WHERE a.order_id > ? AND a.order_id <= ? AND o.status != 'cancelled'
+            GROUP BY a.product_id, b.product_id
+            ON CONFLICT (product_id, related_product_id)
+            DO UPDATE SET orders_count = orders_count + excluded.orders_count
+        """, (last_order, upper))
+        cur.execute("""
+            INSERT OR IGNORE INTO recommendations_pending (product_id)
+            SELECT DISTINCT oi.product_id
+            FROM order_items oi JOIN orders o ON o.order_id = oi.order_id
+            WHERE oi.order_id > ? AND oi.order_id <= ? AND o.status != 'cancelled'
+        """, (last_order, upper))
+        cur.execute("""
+            INSERT INTO job_state (name, value) VALUES ('recommendations_last_order', ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (upper,))
+        db.commit()
+        
+        report['orders'] += upper - last_order
+        last_order = upper
+        time.sleep(pause)
+    
+    # Phase 2: rank each touched product once, however many chunks it appeared in
+    while True:
+        cur.execute("SELECT product_id FROM recommendations_pending ORDER BY product_id LIMIT ?",
+                    (rank_batch,))
+        product_ids = [row[0] for row in cur.fetchall()]
+        if not product_ids:
+            break
+        
+        placeholders = ','.join(['?'] * len(product_ids))
+        cur.execute(f"DELETE FROM product_recommendations WHERE product_id IN ({placeholders})",
+                    product_ids)
+        cur.execute(f"""
+            INSERT INTO product_recommendations (product_id, rank, related_product_id, score)
+            SELECT product_id, rank, related_product_id, orders_count FROM (
+                SELECT c.product_id, c.related_product_id, c.orders_count,
+                       ROW_NUMBER() OVER (PARTITION BY c.product_id
+                                          ORDER BY c.orders_count DESC, c.related_product_id) as rank
+                FROM product_copurchases c
+                JOIN products p ON p.product_id = c.related_product_id
+                WHERE c.product_id IN ({placeholders})
+            )
+            WHERE rank <= ?
+        """, (*product_ids, top_n))
+        cur.execute(f"DELETE FROM recommendations_pending WHERE product_id IN ({placeholders})",
+                    product_ids)
+        db.commit()
+        
+        report['products'] += len(product_ids)
+        time.sleep(pause)
+    
+    cur.close()
+    log_job('refresh_recommendations', started, rebuild=rebuild, **report)
+    return report
+
+@app.cli.command('refresh-recommendations')
+@click.option('--rebuild', is_flag=True, help='Recompute from all orders instead of only new ones.')
+@with_schema
+def refresh_recommendations_command(rebuild):
+    """Update "customers also bought" recommendations from new orders."""
+    started = time.time()
+    report = refresh_recommendations(rebuild=rebuild)
+    print(f"Processed {report['orders']} orders, refreshed recommendations for "
+          f"{report['products']} products in {time.time() - started:.1f}s")
+
+def archive_orders(days=ARCHIVE_AFTER_DAYS, chunk_size=ARCHIVE_CHUNK_SIZE, pause=ARCHIVE_PAUSE):
+    """Move old orders in a terminal status, with their items, into the archive database in chunks"""
+    started = time.perf_counter()
+    db = get_db()
+    db.commit()  # ATTACH can't run inside a transaction
+    attach_archive(db, create=True)
+    cur = db.cursor()
+    statuses = ','.join(['?'] * len(ARCHIVE_STATUSES))
+    report = {'orders': 0, 'items': 0}
+    
+    while True:
+        cur.execute(f"""
+            SELECT order_id FROM main.orders
+            WHERE status IN ({statuses}) AND created_at < datetime('now', ?)
+            ORDER BY order_id
+            LIMIT ?
+        """, (*ARCHIVE_STATUSES, f'-{days} days', chunk_size))
+        order_ids = [row[0] for row in cur.fetchall()]
+        if not order_ids:
+            break
+        
+        placeholders = ','.join(['?'] * len(order_ids))
+        try:
+            # Copy first, then delete. In WAL mode a transaction spanning two files is not
+            # atomic, so the copy is committed on its own: if the delete never happens, the
+            # next run copies the same rows again (INSERT OR REPLACE) and then deletes them
+            cur.execute(f"""
+                INSERT OR REPLACE INTO archive.orders (order_id, user_id, total, status, created_at)
+                SELECT order_id, user_id, total, status, created_at
+                FROM main.orders WHERE order_id IN ({placeholders})
+            """, order_ids)
+            cur.execute(f"""
+                INSERT OR REPLACE INTO archive.order_items (item_id, order_id, product_id, quantity, price_at_purchase)
+                SELECT item_id, order_id, product_id, quantity, price_at_purchase
+                FROM main.order_items WHERE order_id IN ({placeholders})
+            """, order_ids)
+            report['items'] += cur.rowcount
+            db.commit()
+            cur.execute(f"DELETE FROM main.order_items WHERE order_id IN ({placeholders})", order_ids)
+            cur.execute(f"DELETE FROM main.orders WHERE order_id IN ({placeholders})", order_ids)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        
+        report['orders'] += len(order_ids)
+        time.sleep(pause)
+    
+    cur.close()
+    log_job('archive_orders', started, days=days, **report)
+    return report
+
+@app.cli.command('archive-orders')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive shipped/cancelled orders older than this many days.')
+@click.option('--chunk-size', default=ARCHIVE_CHUNK_SIZE, show_default=True, help='Orders moved per transaction.')
+@with_schema
+def archive_orders_command(days, chunk_size):
+    """Move old, finished orders into the archive database."""
+    report = archive_orders(days=days, chunk_size=chunk_size)
+    print(f"Archived {report['orders']} orders ({report['items']} items) "
+          f"into {app.config['ARCHIVE_DATABASE']}")
+
+def backup_database(compress=True, keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE):
+    """Snapshot the live database with the online backup API, verify it and rotate old snapshots"""
+    started = time.perf_counter()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    # The random suffix keeps two snapshots taken within the same second apart
+    target = os.path.join(BACKUP_DIR, f"eshop-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.db")
+    
+    source = sqlite3.connect(app.config['DATABASE'])
+    dest = sqlite3.connect(target)
+    try:
+        # Copy a few pages at a time, sleeping in between so the source is never locked for long
+        source.backup(dest, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+        integrity = dest.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        dest.close()
+        source.close()
+    
+    if integrity != 'ok':
+        os.remove(target)
+        raise RuntimeError(f"Backup failed integrity check: {integrity}")
+    
+    if compress:
+        with open(target, 'rb') as f_in, gzip.open(target + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(target)
+        target += '.gz'
+    
+    # Keep only the newest snapshots
+    snapshots = sorted(name for name in os.listdir(BACKUP_DIR)
+                       if name.startswith('eshop-') and name.endswith(('.db', '.db.gz')))
+    for name in snapshots[:-keep] if keep else []:
+        os.remove(os.path.join(BACKUP_DIR, name))
+    
+    result = {'file': target, 'size': os.path.getsize(target), 'integrity': integrity,
+              'created_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    log_job('backup_database', started, **result)
+    return result
+
+def acquire_backup_lock():
+    """Take the backup lock shared by every process; returns the lock file, or None if a backup is running"""
+    if not backup_lock.acquire(blocking=False):
+        return None
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        lock_file = open(os.path.join(BACKUP_DIR, 'backup.lock'), 'a')
+    except OSError:
+        backup_lock.release()
+        raise
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            backup_lock.release()
+            return None
+    return lock_file
+
+def release_backup_lock(lock_file):
+    lock_file.close()  # closing the file drops the flock
+    backup_lock.release()
+
+def read_backup_status():
+    """Outcome of the latest backup from any process, and whether one is running now"""
+    try:
+        with open(os.path.join(BACKUP_DIR, 'status.json'), encoding='utf-8') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        status = {'last': None, 'error': None}
+    
+    lock_file = acquire_backup_lock()
+    status['running'] = lock_file is None
+    if lock_file is not None:
+        release_backup_lock(lock_file)
+    return status
+
+def write_backup_status(last, error):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_DIR, 'status.json')
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'last': last, 'error': error}, f)
+    os.replace(temp_path, path)
+
+def run_backup(lock_file, **options):
+    """Run a backup while holding the lock, record its outcome in status.json and release the lock"""
+    try:
+        result = backup_database(**options)
+        write_backup_status(result, None)
+        return result
+    except Exception as e:
+        write_backup_status(read_backup_status().get('last'), str(e))
+        raise
+    finally:
+        release_backup_lock(lock_file)
+
+def run_backup_in_background(lock_file):
+    """Run a backup on a worker thread; failures end up in status.json and the log"""
+    try:
+        run_backup(lock_file)
+    except Exception:
+        app.logger.exception("Backup failed")
+
+@app.cli.command('backup-db')
+@click.option('--no-compress', is_flag=True, help='Keep the snapshot as a plain .db file.')
+@click.option('--keep', default=BACKUP_KEEP, show_default=True, help='Snapshots to keep (0 = all).')
+def backup_db_command(no_compress, keep):
+    """Take an online, verified snapshot of the database."""
+    lock_file = acquire_backup_lock()
+    if lock_file is None:
+        raise click.ClickException('A backup is already running')
+    result = run_backup(lock_file, compress=not no_compress, keep=keep)
+    print(f"Backup written to {result['file']} ({result['size'] / 1024:.1f} KB, integrity {result['integrity']})")
+
 # Favicon route to prevent 404 errors
 @app.route('/favicon.ico')
 def favicon():
     try:
         return send_from_directory(os.path.join(app.root_path, 'static', 'images'),
                                  'favicon.ico', 
-                                 mimetype='image/vnd.microsoft.icon')
+                                 mimetype='image/vnd.microsoft.icon',
+                                 max_age=FAVICON_MAX_AGE)
     except:
         # If favicon doesn't exist, return empty response
         return '', 204
     
+@app.route('/uploads/<path:filename>')
+def serve_upload(filename):
+    """Serve uploaded product images with immutable caching, ETags and byte ranges"""
+    path = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    
+    # Upload names are unique, so the name alone identifies the content
+    etag = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    
+    if UPLOAD_ACCEL_REDIRECT:
+        # nginx serves the bytes (and handles ranges/conditionals) from its internal location
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = UPLOAD_ACCEL_REDIRECT.rstrip('/') + '/' + filename
+        response.set_etag(etag)
+    else:
+        # send_file answers If-None-Match with 304, honours Range and uses X-Sendfile when enabled
+        response = send_file(path, etag=etag, conditional=True, max_age=UPLOAD_MAX_AGE)
+    
+    response.cache_control.public = True
+    response.cache_control.max_age = UPLOAD_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/health')
+def health():
+    """Readiness check used by the process manager / load balancer"""
+    try:
+        with get_cursor() as cur:
+            cur.execute("SELECT 1 FROM products LIMIT 1")
+            cur.fetchall()
+    except sqlite3.Error as e:
+        return jsonify({'status': 'unavailable', 'database': str(e)}), 503
+    return jsonify({'status': 'ok', 'database': 'ok'})
+
+@app.route('/metrics')
+def metrics():
+    # Optional bearer token so the endpoint can be exposed beyond the scraper's network
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return 'Unauthorized', 401
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route("/")
 def home():
     page = request.args.get('page', 1, type=int)
@@ -357,79 +2473,29 @@ def home():
     sort_by = request.args.get('sort', 'newest')
     min_price = request.args.get('min_price', '')
     max_price = request.args.get('max_price', '')
-    per_page = 12
+    per_page = CATALOG_PER_PAGE
+    
+    # products.js asks for just the results fragment when filters or the page change
+    partial = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    g._partial = partial
+    template = 'catalog_results.html' if partial else 'index.html'
     
     try:
-        with get_cursor() as cur:
-            # Build query based on filters
-            query = "SELECT * FROM products"
-            count_query = "SELECT COUNT(*) FROM products"
-            params = []
-            conditions = []
-            
-            if search_query:
-                conditions.append("name LIKE ?")
-                params.append(f'%{search_query}%')
-            
-            if category:
-                conditions.append("category = ?")
-                params.append(category)
-            
-            # Stock filter
-            if stock_filter == 'in_stock':
-                conditions.append("stock_quantity > 0")
-            elif stock_filter == 'out_of_stock':
-                conditions.append("stock_quantity = 0")
-            # 'all' shows everything, so no condition needed
-            
-            # Price range filtering
-            if min_price:
-                try:
-                    conditions.append("price >= ?")
-                    params.append(float(min_price))
-                except ValueError:
-                    pass
-            
-            if max_price:
-                try:
-                    conditions.append("price <= ?")
-                    params.append(float(max_price))
-                except ValueError:
-                    pass
-            
-            if conditions:
-                where_clause = " WHERE " + " AND ".join(conditions)
-                query += where_clause
-                count_query += where_clause
-            
-            # Get total count
-            cur.execute(count_query, params)
-            total = cur.fetchone()[0]
-            
-            # Add sorting
-            sort_map = {
-                'newest': 'created_at DESC',
-                'oldest': 'created_at ASC',
-                'price_low': 'price ASC',
-                'price_high': 'price DESC',
-                'name_az': 'name ASC',
-                'name_za': 'name DESC'
-            }
-            sort_clause = sort_map.get(sort_by, 'created_at DESC')
-            
-            # Get products with pagination
-            query += f" ORDER BY {sort_clause} LIMIT ? OFFSET ?"
-            params.extend([per_page, (page-1)*per_page])
-            cur.execute(query, params)
-            products = cur.fetchall()
-            
-            # Get distinct categories for filter
-            cur.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != '' ORDER BY category")
-            categories = [row[0] for row in cur.fetchall()]
+        filters = dict(search_query=search_query, category=category, stock_filter=stock_filter,
+                       min_price=parse_price(min_price), max_price=parse_price(max_price), sort_by=sort_by,
+                       limit=per_page, offset=max(page - 1, 0) * per_page)
+        
+        engine = get_catalog_engine() if app.config.get('CATALOG_ENGINE') else None
+        if engine is not None:
+            products, total = engine.query(**filters)
+        else:
+            with get_cursor() as cur:
+                products, total = query_catalog_sql(cur, **filters)
             
         total_pages = (total + per_page - 1) // per_page
+        preload_images(get_image_url(product['image_url']) for product in products[:PRELOAD_IMAGES])
         
-        return render_template('index.html', 
+        response = make_response(render_template(template, 
                              products=products, 
                              page=page, 
                              per_page=per_page, 
@@ -437,15 +2503,38 @@ def home():
                              total_pages=total_pages,
                              search_query=search_query,
                              category=category,
-                             categories=categories,
                              stock_filter=stock_filter,
                              sort_by=sort_by,
                              min_price=min_price,
-                             max_price=max_price)
+                             max_price=max_price))
+        # The fragment and the full page share a URL, so caches must keep them apart
+        response.vary.add('X-Requested-With')
+        return response
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
+        if partial:
+            abort(500)
         flash(f"Error loading products: {str(e)}", 'danger')
-        return render_template('index.html', products=[], page=1, total=0, total_pages=0, categories=[])
+        return render_template('index.html', products=[], page=1, total=0, total_pages=0, stock_filter='all')
+    
+@app.route('/api/suggest')
+def suggest():
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', SUGGEST_LIMIT, type=int), 20))
+    
+    suggestions = []
+    for (kind, value), entry in get_suggest_index().search(query, limit):
+        if kind == 'product':
+            url = url_for('product_detail', product_id=value)
+        else:
+            url = url_for('home', category=value)
+        suggestions.append({'type': kind, 'label': entry['label'], 'url': url})
     
+    response = jsonify({'query': query, 'suggestions': suggestions})
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
+
 @app.route('/search')
 def search():
     query = request.args.get('q', '')
@@ -497,6 +2586,7 @@ def register():
             return redirect(url_for('login'))
         
         except Exception as e:
+            app.logger.exception("Error in %s", request.endpoint)
             flash(f"Registration error: {str(e)}", 'danger')
             return render_template('register.html')
     
@@ -536,6 +2626,7 @@ def login():
                 return render_template('login.html')
     
         except Exception as e:
+            app.logger.exception("Error in %s", request.endpoint)
             flash(f"Login error: {str(e)}", 'danger')
             return render_template("login.html")
     
@@ -555,14 +2646,25 @@ def product_detail(product_id):
         with get_cursor() as cur:
             cur.execute("SELECT * FROM products WHERE product_id = ?", (product_id,))
             product = cur.fetchone()
+            
+            # Precomputed by refresh_recommendations(), a single primary-key range lookup
+            cur.execute("""
+                SELECT p.* FROM product_recommendations r
+                JOIN products p ON p.product_id = r.related_product_id
+                WHERE r.product_id = ?
+                ORDER BY r.rank
+            """, (product_id,))
+            recommendations = cur.fetchall()
         
         if not product:
             flash('Product not found', 'danger')
             return redirect(url_for('home'))
         
-        return render_template('product.html', product=product)
+        preload_images([get_image_url(product['image_url'])])
+        return render_template('product.html', product=product, recommendations=recommendations)
     
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error loading product: {str(e)}", 'danger')
         return redirect(url_for('home'))
 
@@ -636,6 +2738,7 @@ def add_to_cart():
         return redirect(request.referrer or url_for('home'))
         
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'message': f"Error: {str(e)}"})
         flash(f"Error adding to cart: {str(e)}", 'danger')
@@ -683,6 +2786,7 @@ def update_cart():
     except ValueError:
         flash('Invalid quantity', 'danger')
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error updating cart: {str(e)}", 'danger')
     
     return redirect(url_for('view_cart'))
@@ -740,6 +2844,7 @@ def view_cart():
         return render_template("cart.html", cart_items=cart_items, total=total)
     
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error loading cart: {str(e)}", "danger")
         # If there's an error, clear the cart to prevent further issues
         session.pop('cart', None)
@@ -757,6 +2862,104 @@ def remove_from_cart():
             flash('Item removed from cart', 'success')
     return redirect(url_for('view_cart'))
 
+@app.route('/api/cart', methods=['POST'])
+def batch_update_cart():
+    """Apply a list of {product_id, quantity delta} changes to the cart.
+    
+    By default the batch is all or nothing. With "atomic": false each change is checked
+    and applied on its own, in order, and the rejected ones are listed in "errors".
+    """
+    data = request.get_json(silent=True)
+    changes = data.get('changes') if isinstance(data, dict) else None
+    if not isinstance(changes, list) or not changes or len(changes) > CART_BATCH_MAX_CHANGES:
+        return jsonify({'success': False, 'message': f'Send between 1 and {CART_BATCH_MAX_CHANGES} changes'})
+    atomic = data.get('atomic', True) is not False
+    
+    try:
+        parsed = [(str(int(change['product_id'])), int(change['quantity'])) for change in changes]
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return jsonify({'success': False, 'message': 'Invalid cart change'})
+    if any(abs(quantity) > CART_MAX_QUANTITY for _, quantity in parsed):
+        return jsonify({'success': False, 'message': 'Invalid cart change'})
+    
+    cart = dict(session.get('cart', {}))
+    # One lookup covers the changed products and everything already in the cart
+    product_ids = sorted(set(cart) | {pid for pid, _ in parsed}, key=int)
+    placeholders = ','.join(['?'] * len(product_ids))
+    try:
+        with get_cursor() as cur:
+            cur.execute(
+                f"SELECT product_id, name, price, stock_quantity FROM products WHERE product_id IN ({placeholders})",
+                product_ids
+            )
+            products = {str(row['product_id']): row for row in cur.fetchall()}
+    except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
+        return jsonify({'success': False, 'message': f"Error: {str(e)}"})
+    
+    def change_error(pid, new_quantity):
+        product = products.get(pid)
+        if product is None:
+            return 'Product not found'
+        if new_quantity > 0 and product['stock_quantity'] == 0:
+            return f"{product['name']} is out of stock"
+        if new_quantity > product['stock_quantity']:
+            return f"Cannot add more than {product['stock_quantity']} units of {product['name']}"
+        return None
+    
+    def apply_change(pid, delta):
+        new_quantity = cart.get(pid, 0) + delta
+        if new_quantity > 0:
+            cart[pid] = new_quantity
+        else:
+            cart.pop(pid, None)
+    
+    errors = []
+    applied = {}
+    if atomic:
+        for pid, delta in parsed:
+            applied[pid] = applied.get(pid, 0) + delta
+        for pid, delta in applied.items():
+            message = change_error(pid, cart.get(pid, 0) + delta)
+            if message:
+                errors.append({'product_id': int(pid), 'message': message})
+        if errors:
+            # Nothing is applied unless every change is valid
+            return jsonify({'success': False, 'message': errors[0]['message'], 'errors': errors})
+        for pid, delta in applied.items():
+            apply_change(pid, delta)
+    else:
+        for index, (pid, delta) in enumerate(parsed):
+            message = change_error(pid, cart.get(pid, 0) + delta)
+            if message:
+                errors.append({'index': index, 'product_id': int(pid), 'message': message})
+                continue
+            apply_change(pid, delta)
+            applied[pid] = applied.get(pid, 0) + delta
+        if not applied:
+            return jsonify({'success': False, 'message': errors[0]['message'], 'errors': errors})
+    
+    # Drop anything that no longer exists
+    cart = {pid: qty for pid, qty in cart.items() if pid in products}
+    session['cart'] = cart
+    session.modified = True
+    
+    if len(applied) == 1:
+        pid, delta = next(iter(applied.items()))
+        verb = 'added to' if delta > 0 else 'updated in' if pid in cart else 'removed from'
+        message = f"{products[pid]['name']} {verb} cart!"
+    else:
+        message = f"{len(applied)} items updated in cart!"
+    
+    return jsonify({
+        'success': True,
+        'message': message,
+        'errors': errors,
+        'cart_count': sum(cart.values()),
+        'items': [{'product_id': int(pid), 'quantity': qty} for pid, qty in cart.items()],
+        'total': round(sum(products[pid]['price'] * qty for pid, qty in cart.items()), 2),
+    })
+
 @app.route("/checkout", methods=['GET', 'POST'])
 @login_required
 def checkout():
@@ -852,7 +3055,8 @@ def checkout():
             )
             order_id = cur.lastrowid
             
-            # Add order items and update stock
+            # Add order items, update stock and the best-seller counters
+            weight = popularity_weight()
             for pid, qty in cart.items():
                 product = products[pid]
                 cur.execute(
@@ -861,10 +3065,11 @@ def checkout():
                     VALUES (?, ?, ?, ?)""",
                     (order_id, int(pid), qty, product['price'])
                 )
-                # Update stock
                 cur.execute(
-                    "UPDATE products SET stock_quantity = stock_quantity - ? WHERE product_id = ?",
-                    (qty, int(pid))
+                    """UPDATE products
+                    SET stock_quantity = stock_quantity - ?, units_sold = units_sold + ?, popularity = popularity + ?
+                    WHERE product_id = ?""",
+                    (qty, qty, qty * weight, int(pid))
                 )
             
             db.commit()
@@ -881,74 +3086,102 @@ def checkout():
             raise e
             
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Checkout failed: {str(e)}", 'danger')
         return redirect(url_for('view_cart'))
 
 @app.route('/orders')
 @login_required
 def user_orders():
+    # Recent orders live in the main database and the list continues into the archive,
+    # which is only read once every recent row has been sent
     try:
-        with get_cursor() as cur:
-            if session['role'] == 'admin':
-                # Admin sees all orders with customer info
-                cur.execute("""
-                    SELECT o.*, 
-                           u.username, 
-                           u.email,
-                           GROUP_CONCAT(p.name || ' (x' || oi.quantity || ')') as product_names
-                    FROM orders o
-                    JOIN users u ON o.user_id = u.user_id
-                    JOIN order_items oi ON o.order_id = oi.order_id
-                    JOIN products p ON oi.product_id = p.product_id
-                    GROUP BY o.order_id
-                    ORDER BY o.created_at DESC
+        db = get_db()
+        schemas = ['main', 'archive'] if attach_archive(db) else ['main']
+        
+        def recent_then_archived(cur, sql, params):
+            for schema in schemas:
+                cur.execute(sql.format(schema=schema, archived=int(schema == 'archive')), params)
+                yield from cur
+        
+        # Rows are streamed straight from the cursor into the template, so the
+        # cursor stays open until the response finishes
+        cur = db.cursor()
+        if session['role'] == 'admin':
+            stats = {'total': 0, 'pending': 0, 'paid': 0, 'shipped': 0}
+            for schema in schemas:
+                cur.execute(f"""
+                    SELECT COUNT(*) as total,
+                           COALESCE(SUM(status = 'pending'), 0) as pending,
+                           COALESCE(SUM(status = 'paid'), 0) as paid,
+                           COALESCE(SUM(status = 'shipped'), 0) as shipped
+                    FROM {schema}.orders
                 """)
-                orders = cur.fetchall()
-                return render_template('admin_orders.html', orders=orders)
-            else:
-                # Regular users only see their own orders
-                cur.execute("""
-                    SELECT o.*, 
-                           GROUP_CONCAT(p.name || ' (x' || oi.quantity || ')') as product_names
-                    FROM orders o
-                    JOIN order_items oi ON o.order_id = oi.order_id
-                    JOIN products p ON oi.product_id = p.product_id
-                    WHERE o.user_id = ?
-                    GROUP BY o.order_id
-                    ORDER BY o.created_at DESC
-                """, (session['user_id'],))
-                orders = cur.fetchall()
-                return render_template('user_orders.html', orders=orders)
+                for key, value in dict(cur.fetchone()).items():
+                    stats[key] += value
+            
+            # Admin sees all orders with customer info
+            orders = recent_then_archived(cur, """
+                SELECT o.*, {archived} as archived,
+                       u.username, 
+                       u.email,
+                       GROUP_CONCAT(p.name || ' (x' || oi.quantity || ')') as product_names
+                FROM {schema}.orders o
+                JOIN users u ON o.user_id = u.user_id
+                JOIN {schema}.order_items oi ON o.order_id = oi.order_id
+                JOIN products p ON oi.product_id = p.product_id
+                GROUP BY o.order_id
+                ORDER BY o.created_at DESC
+            """, ())
+            return stream_page('admin_orders.html', orders=orders, stats=stats)
+        else:
+            order_count = 0
+            for schema in schemas:
+                cur.execute(f"SELECT COUNT(*) FROM {schema}.orders WHERE user_id = ?", (session['user_id'],))
+                order_count += cur.fetchone()[0]
+            
+            # Regular users only see their own orders
+            orders = recent_then_archived(cur, """
+                SELECT o.*, {archived} as archived,
+                       GROUP_CONCAT(p.name || ' (x' || oi.quantity || ')') as product_names
+                FROM {schema}.orders o
+                JOIN {schema}.order_items oi ON o.order_id = oi.order_id
+                JOIN products p ON oi.product_id = p.product_id
+                WHERE o.user_id = ?
+                GROUP BY o.order_id
+                ORDER BY o.created_at DESC
+            """, (session['user_id'],))
+            return stream_page('user_orders.html', orders=orders, order_count=order_count)
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error loading orders: {str(e)}", 'danger')
         # Return appropriate template based on role
         if session.get('role') == 'admin':
-            return render_template('admin_orders.html', orders=[])
+            return render_template('admin_orders.html', orders=[],
+                                 stats={'total': 0, 'pending': 0, 'paid': 0, 'shipped': 0})
         else:
-            return render_template('user_orders.html', orders=[])
+            return render_template('user_orders.html', orders=[], order_count=0)
 
 
 @app.route('/admin/products')
 @admin_required
 def admin_products():
     try:
-        with get_cursor() as cur:
-            # Fetch products
-            cur.execute("SELECT * FROM products ORDER BY created_at DESC")
-            products = cur.fetchall()
-            
-            # Fetch orders with user information
-            cur.execute("""
-                SELECT o.order_id, o.total, o.status, o.created_at, 
-                       u.username, u.email
-                FROM orders o
-                JOIN users u ON o.user_id = u.user_id
-                ORDER BY o.created_at DESC
-            """)
-            orders = cur.fetchall()
-            
-        return render_template('admin_products.html', products=products, orders=orders)
+        cur = get_db().cursor()
+        cur.execute("""
+            SELECT COUNT(*) as total,
+                   COALESCE(SUM(stock_quantity > 0), 0) as in_stock,
+                   COALESCE(SUM(stock_quantity = 0), 0) as out_of_stock,
+                   COALESCE(SUM(stock_quantity > 0 AND stock_quantity < 10), 0) as low_stock
+            FROM products
+        """)
+        stats = dict(cur.fetchone())
+        
+        # Products are streamed from the cursor while the page renders
+        cur.execute("SELECT * FROM products ORDER BY created_at DESC")
+        return stream_page('admin_products.html', products=cur, stats=stats, backup=read_backup_status())
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error: {str(e)}", 'danger')
         return redirect(url_for('home'))
 
@@ -1009,6 +3242,7 @@ def add_product():
             flash('Product added successfully!', 'success')
             return redirect(url_for('admin_products'))
         except Exception as e:
+            app.logger.exception("Error in %s", request.endpoint)
             flash(f"Error adding product: {str(e)}", 'danger')
             return render_template('add_product.html')
     
@@ -1080,6 +3314,7 @@ def edit_product(product_id):
                     return redirect(url_for('admin_products'))
                 return render_template('edit_product.html', product=product)
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error: {str(e)}", 'danger')
         return redirect(url_for('admin_products'))
 
@@ -1095,16 +3330,64 @@ def delete_product(product_id):
             """, (product_id,))
             order_count = cur.fetchone()[0]
             
+            # Archived orders still reference the product
+            if order_count == 0 and attach_archive(cur.connection):
+                cur.execute("SELECT COUNT(*) FROM archive.order_items WHERE product_id = ?", (product_id,))
+                order_count = cur.fetchone()[0]
+            
             if order_count > 0:
                 flash('Cannot delete product that has been ordered. Consider archiving instead.', 'danger')
             else:
                 cur.execute("DELETE FROM products WHERE product_id = ?", (product_id,))
-                flash('Product deleted successfully!', 'success')
+        
+        if order_count == 0:
+            flash('Product deleted successfully!', 'success')
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         flash(f"Error deleting product: {str(e)}", 'danger')
     
     return redirect(url_for('admin_products'))
 
+@app.route('/admin/backup', methods=['POST'])
+@admin_required
+def admin_backup():
+    lock_file = acquire_backup_lock()
+    if lock_file is None:
+        flash('A backup is already running', 'warning')
+        return redirect(url_for('admin_products'))
+    
+    threading.Thread(target=run_backup_in_background, args=(lock_file,), daemon=True).start()
+    flash('Backup started. Live traffic is not blocked while it runs.', 'info')
+    return redirect(url_for('admin_products'))
+
+@app.route('/admin/slow_queries')
+@admin_required
+def admin_slow_queries():
+    entries = sorted(collect_metrics()['slow_queries'].values(),
+                     key=lambda entry: entry['total_ms'], reverse=True)[:50]
+    return render_template('admin_slow_queries.html',
+                         queries=entries,
+                         threshold_ms=app.config['SLOW_QUERY_MS'])
+
+@app.route('/admin/profiles')
+@app.route('/admin/profiles/<profile_id>')
+@admin_required
+def admin_profiles(profile_id=None):
+    profile = None
+    if profile_id:
+        profile = load_profile(profile_id)
+        if not profile:
+            flash('Profile not found', 'danger')
+            return redirect(url_for('admin_profiles'))
+    
+    profiles = [load_profile(pid) for pid in list_profiles()]
+    token = get_profile_serializer().dumps({'user_id': session['user_id']})
+    return render_template('admin_profiles.html',
+                         profiles=[p for p in profiles if p],
+                         profile=profile,
+                         token=token,
+                         token_max_age=PROFILE_TOKEN_MAX_AGE)
+
 # Add this route for admin order status updates
 @app.route('/admin/update_order/<int:order_id>', methods=['POST'])
 @admin_required
@@ -1121,9 +3404,13 @@ def update_order_status(order_id):
                 "UPDATE orders SET status = ? WHERE order_id = ?",
                 (new_status, order_id)
             )
+            # Archived orders are read-only and not in the main orders table
+            if cur.rowcount == 0:
+                return jsonify({'success': False, 'error': 'Order not found or archived'})
         
         return jsonify({'success': True})
     except Exception as e:
+        app.logger.exception("Error in %s", request.endpoint)
         return jsonify({'success': False, 'error': str(e)})
 
 # Error handlers
@@ -1146,17 +3433,5 @@ def handle_exception(error):
     return render_template('500.html'), 500
 
 if __name__ == '__main__':
-    # Initialize database if it doesn't exist
-    if not os.path.exists(DATABASE):
-        init_db()
-        print("Database created successfully!")
-    else:
-        # Always ensure tables exist
-        init_db()
-    
-    # Ensure upload folder exists
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-        print(f"Upload folder created: {UPLOAD_FOLDER}")
-    
-    app.run(debug=True)
\ No newline at end of file
+    # Development server; use gunicorn with gunicorn.conf.py in production
+    create_app().run(debug=True)
@@ -0,0 +1,26 @@
+# Gunicorn configuration for production
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# The app is preloaded in the master so templates and caches are built once
+# and shared copy-on-write by the forked workers.
+# Graceful reload: kill -HUP <master pid> (workers finish in-flight requests first).
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+# /metrics and /admin/slow_queries add up every worker's counters through METRICS_DIR
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# The app's admission control reads THREADS too: cart and checkout keep threads for their
+# in-flight slots and every other request shares what is left
+threads = int(os.environ.get('THREADS', 16))
+timeout = int(os.environ.get('TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.environ.get('MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 100))
+
+preload_app = True
+accesslog = os.environ.get('ACCESS_LOG', '-')
+errorlog = os.environ.get('ERROR_LOG', '-')
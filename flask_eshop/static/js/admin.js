@@ -96,7 +96,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     alert(`Order #${orderId} status updated to ${status}`);
                     location.reload();
                 } else {
-                    alert('Error updating order status');
+                    alert(data.error || 'Error updating order status');
                 }
             })
             .catch(error => {
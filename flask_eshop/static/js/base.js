@@ -323,26 +323,10 @@ function handleAddToCart(e) {
     submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Adding...';
     submitBtn.disabled = true;
     
-    const url = form.action || window.APP_URLS.add_to_cart;
-    
-    fetch(url, {
-        method: 'POST',
-        body: formData,
-        headers: {
-            'X-Requested-With': 'XMLHttpRequest'
-        }
-    })
-    .then(response => {
-        if (!response.ok) {
-            throw new Error('Network response was not ok');
-        }
-        return response.json();
-    })
+    // Rapid clicks are coalesced into one /api/cart request by queueCartChange()
+    queueCartChange(parseInt(productId), quantity)
     .then(data => {
         if (data.success) {
-            updateCartCount(data.cart_count);
-            showToast(data.message, 'success');
-            
             // If we're on a product page, update the stock display
             if (productId) {
                 updateProductStockDisplay(productId, quantity);
@@ -355,21 +339,88 @@ function handleAddToCart(e) {
                 }, 1000);
             }
         } else {
-            showToast(data.message, 'error');
             // Re-enable button on error
             submitBtn.disabled = false;
             submitBtn.innerHTML = originalText;
         }
     })
-    .catch(error => {
-        console.error('Error adding to cart:', error);
-        showToast('Error adding item to cart. Please try again.', 'error');
+    .catch(() => {
         // Re-enable button on error
         submitBtn.disabled = false;
         submitBtn.innerHTML = originalText;
     });
 }
 
+// Cart changes made within this many milliseconds are sent together
+const CART_BATCH_DELAY = 150;
+let pendingCartChanges = [];
+let cartBatchTimer = null;
+
+function queueCartChange(productId, quantity) {
+    return new Promise((resolve, reject) => {
+        pendingCartChanges.push({ product_id: productId, quantity: quantity, resolve: resolve, reject: reject });
+        clearTimeout(cartBatchTimer);
+        cartBatchTimer = setTimeout(flushCartChanges, CART_BATCH_DELAY);
+    });
+}
+
+function flushCartChanges() {
+    const batch = pendingCartChanges;
+    pendingCartChanges = [];
+    
+    // The clicks are independent, so ask the server to apply each one on its own
+    updateCart(batch.map(change => ({ product_id: change.product_id, quantity: change.quantity })), { atomic: false })
+    .then(data => {
+        const errors = {};
+        (data.errors || []).forEach(error => { errors[error.index] = error; });
+        
+        if (data.success) {
+            updateCartCount(data.cart_count);
+            showToast(data.message, 'success');
+        }
+        // One toast per distinct problem, not just the first
+        [...new Set(Object.values(errors).map(error => error.message))].forEach(message => {
+            showToast(message, 'error');
+        });
+        if (!data.success && !Object.keys(errors).length) {
+            showToast(data.message, 'error');
+        }
+        
+        batch.forEach((change, index) => {
+            const error = errors[index];
+            change.resolve(data.success && !error ? data : { success: false, message: error ? error.message : data.message });
+        });
+    })
+    .catch(error => {
+        console.error('Error updating cart:', error);
+        showToast('Error adding item to cart. Please try again.', 'error');
+        batch.forEach(change => change.reject(error));
+    });
+}
+
+// Apply several {product_id, quantity} changes in one request; all succeed or none do
+// unless options.atomic is false, in which case each change is applied on its own and
+// the rejected ones come back in data.errors (with their index in changes).
+// Resolves with the cart summary (cart_count, items, total). Used by quick-add style flows.
+function updateCart(changes, options = {}) {
+    return fetch(window.APP_URLS.cart_batch, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-Requested-With': 'XMLHttpRequest'
+        },
+        body: JSON.stringify({ changes: changes, atomic: options.atomic !== false })
+    })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('Network response was not ok');
+        }
+        return response.json();
+    });
+}
+
+window.updateCart = updateCart;
+
 function initCartQuantityControls() {
     document.querySelectorAll('.quantity-input').forEach(input => {
         input.addEventListener('change', function() {
@@ -446,23 +497,104 @@ function initSearchEnhancements() {
     const searchForm = document.querySelector('.header-search-form');
     
     if (searchInput && searchForm) {
-        searchInput.addEventListener('input', debounce(handleSearchInput, 300));
+        searchInput.addEventListener('input', debounce(handleSearchInput, 120));
         
         searchInput.addEventListener('keydown', function(e) {
-            if (e.key === 'Enter') {
+            if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+                e.preventDefault();
+                moveSuggestionFocus(e.key === 'ArrowDown' ? 1 : -1);
+            } else if (e.key === 'Escape') {
+                hideSuggestions();
+            } else if (e.key === 'Enter') {
+                const active = document.querySelector('.suggestion-item.active');
+                if (active) {
+                    e.preventDefault();
+                    window.location.href = active.href;
+                    return;
+                }
                 searchForm.submit();
             }
         });
+        
+        // Close suggestions when clicking elsewhere
+        document.addEventListener('click', function(e) {
+            if (!searchForm.contains(e.target)) {
+                hideSuggestions();
+            }
+        });
     }
     
     initAdminFilters();
 }
 
+let suggestController = null;
+
 function handleSearchInput(e) {
     const query = e.target.value.trim();
     
-    if (query.length > 2) {
-        console.log('Search query:', query);
+    if (!query || !window.APP_URLS.suggest) {
+        hideSuggestions();
+        return;
+    }
+    
+    // Drop the previous request so slow responses can't overwrite newer ones
+    if (suggestController) {
+        suggestController.abort();
+    }
+    suggestController = new AbortController();
+    
+    fetch(`${window.APP_URLS.suggest}?q=${encodeURIComponent(query)}`, { signal: suggestController.signal })
+        .then(response => response.json())
+        .then(data => renderSuggestions(data.suggestions || []))
+        .catch(error => {
+            if (error.name !== 'AbortError') {
+                console.error('Error loading suggestions:', error);
+            }
+        });
+}
+
+function renderSuggestions(suggestions) {
+    const container = document.getElementById('searchSuggestions');
+    if (!container) return;
+    
+    container.innerHTML = '';
+    if (suggestions.length === 0) {
+        hideSuggestions();
+        return;
+    }
+    
+    suggestions.forEach(suggestion => {
+        const item = document.createElement('a');
+        item.className = 'suggestion-item';
+        item.href = suggestion.url;
+        
+        const icon = document.createElement('i');
+        icon.className = suggestion.type === 'category' ? 'fas fa-list' : 'fas fa-box';
+        const label = document.createElement('span');
+        label.textContent = suggestion.label;
+        
+        item.appendChild(icon);
+        item.appendChild(label);
+        container.appendChild(item);
+    });
+    container.classList.add('show');
+}
+
+function moveSuggestionFocus(direction) {
+    const items = Array.from(document.querySelectorAll('.suggestion-item'));
+    if (items.length === 0) return;
+    
+    const current = items.findIndex(item => item.classList.contains('active'));
+    const next = (current + direction + items.length) % items.length;
+    items.forEach(item => item.classList.remove('active'));
+    items[next].classList.add('active');
+}
+
+function hideSuggestions() {
+    const container = document.getElementById('searchSuggestions');
+    if (container) {
+        container.classList.remove('show');
+        container.innerHTML = '';
     }
 }
 
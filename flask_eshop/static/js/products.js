@@ -36,11 +36,13 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    // Add to Cart Animation for product detail page
-    const addToCartForm = document.querySelector('.add-to-cart-form');
+    // Add to Cart Animation for product detail page (the catalog's card forms have no
+    // .btn-add-to-cart button, so this file is safe to load on the home page too)
+    const addToCartButton = document.querySelector('.btn-add-to-cart');
+    const addToCartForm = addToCartButton ? addToCartButton.closest('.add-to-cart-form') : null;
     if (addToCartForm) {
         addToCartForm.addEventListener('submit', function(e) {
-            const button = this.querySelector('.btn-add-to-cart');
+            const button = addToCartButton;
             const originalText = button.innerHTML;
             
             button.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Adding...';
@@ -53,6 +55,90 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Catalog Filters: fetch only the results fragment and swap it in
+    const catalogFilters = document.getElementById('catalogFilters');
+    const catalogResults = document.getElementById('catalogResults');
+    if (catalogFilters && catalogResults) {
+        let catalogController = null;
+
+        function loadCatalog(url, push) {
+            if (catalogController) {
+                catalogController.abort();
+            }
+            catalogController = new AbortController();
+            catalogResults.classList.add('loading');
+            
+            fetch(url, {
+                headers: { 'X-Requested-With': 'XMLHttpRequest' },
+                signal: catalogController.signal
+            })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Network response was not ok');
+                }
+                return response.text();
+            })
+            .then(html => {
+                catalogResults.innerHTML = html;
+                catalogResults.classList.remove('loading');
+                // Cards in the new fragment need the same add-to-cart handling as on page load
+                catalogResults.querySelectorAll('.add-to-cart-form').forEach(form => {
+                    form.addEventListener('submit', handleAddToCart);
+                });
+                if (push) {
+                    history.pushState({ catalog: true }, '', url);
+                }
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') {
+                    // Fall back to a normal page load
+                    window.location.href = url;
+                }
+            });
+        }
+
+        function catalogUrl() {
+            const params = new URLSearchParams();
+            new FormData(catalogFilters).forEach((value, key) => {
+                if (value) {
+                    params.append(key, value);
+                }
+            });
+            const query = params.toString();
+            return catalogFilters.action + (query ? `?${query}` : '');
+        }
+
+        function syncCatalogFilters() {
+            const params = new URLSearchParams(window.location.search);
+            catalogFilters.querySelectorAll('select, input[type="number"]').forEach(field => {
+                const defaultValue = field.tagName === 'SELECT' ? field.options[0].value : '';
+                field.value = params.get(field.name) || defaultValue;
+            });
+        }
+
+        catalogFilters.addEventListener('submit', function(e) {
+            e.preventDefault();
+            loadCatalog(catalogUrl(), true);
+        });
+        
+        catalogFilters.querySelectorAll('select').forEach(select => {
+            select.addEventListener('change', () => loadCatalog(catalogUrl(), true));
+        });
+        
+        catalogResults.addEventListener('click', function(e) {
+            const link = e.target.closest('.pagination a');
+            if (!link) return;
+            e.preventDefault();
+            loadCatalog(link.href, true);
+            catalogFilters.scrollIntoView({ behavior: 'smooth' });
+        });
+        
+        window.addEventListener('popstate', function() {
+            syncCatalogFilters();
+            loadCatalog(window.location.href, false);
+        });
+    }
+
     // Admin Products Page Filtering and Sorting
     const productsTableBody = document.getElementById('productsTableBody');
     if (productsTableBody) {